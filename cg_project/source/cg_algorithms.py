@@ -5,226 +5,499 @@
 import math
 
 
-def draw_line(p_list, algorithm):
+def draw_line(p_list, algorithm, spans=False):
     """绘制线段
 
     :param p_list: (list of list of int: [[x0, y0], [x1, y1]]) 线段的起点和终点坐标
     :param algorithm: (string) 绘制使用的算法，包括'DDA'和'Bresenham'，此处的'Naive'仅作为示例，测试时不会出现
+    :param spans: (bool) 为True时返回水平区段列表[[y, x_start, x_end], ...]而不是像素点坐标列表
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 绘制结果的像素点坐标列表
     """
     x0, y0 = p_list[0]
     x1, y1 = p_list[1]
-    result = []
+    if algorithm == 'DDA' and max(abs(x1 - x0), abs(y1 - y0)) == 0 and not spans:
+        return p_list
+    kernel = LINE_KERNELS.get(algorithm)
+    if kernel is None:
+        return []
+    xs = []
+    ys = []
+    kernel(x0, y0, x1, y1, xs, ys)
+    if spans:
+        return run_length_spans(xs, ys)
     if algorithm == 'Naive':
-        if x0 == x1:
-            for y in range(y0, y1 + 1):
-                result.append((x0, y))
-        else:
-            if x0 > x1:
-                x0, y0, x1, y1 = x1, y1, x0, y0
-            k = (y1 - y0) / (x1 - x0)
-            for x in range(x0, x1 + 1):
-                result.append((x, int(y0 + k * (x - x0))))
-    elif algorithm == 'DDA':
-        length = max(abs(x1 - x0), abs(y1 - y0))
-        if length == 0:
-            return p_list
-        dx = (x1 - x0) / length
-        dy = (y1 - y0) / length
-        x = x0 + 0.5
-        y = y0 + 0.5
-        for i in range(1, length + 1):
-            result.append([int(x), int(y)])
-            x = x + dx
-            y = y + dy
-    elif algorithm == 'Bresenham':
-        x = x0
-        y = y0
-        dx = abs(x1 - x)
-        dy = abs(y1 - y)
-        s1 = sign(x1 - x0)
-        s2 = sign(y1 - y0)
-        if dy > dx:
-            tmp = dx
-            dx = dy
-            dy = tmp
-            interchange = 1
+        return list(zip(xs, ys))
+    return [[x, y] for x, y in zip(xs, ys)]
+
+
+def run_length_spans(xs, ys):
+    """把按绘制顺序排列的像素压缩为水平区段，同一行上相邻的像素合并为一个区段
+
+    :param xs: (list of int) 像素x坐标
+    :param ys: (list of int) 像素y坐标
+    :return: (list of list of int: [[y, x_start, x_end], ...]) 水平区段列表，x_start和x_end都包含在内
+    """
+    result = []
+    if not xs:
+        return result
+    row, x_start, x_end = ys[0], xs[0], xs[0]
+    for x, y in zip(xs, ys):
+        if y == row and x_start - 1 <= x <= x_end + 1:
+            if x < x_start:
+                x_start = x
+            elif x > x_end:
+                x_end = x
         else:
-            interchange = 0
-        e = 2 * dy - dx
-        for i in range(0, dx):
-            result.append([int(x), int(y)])
-            while e > 0:
-                if interchange:
-                    x = x + s1
-                else:
-                    y = y + s2
-                e = e - 2 * dx
+            result.append([row, x_start, x_end])
+            row, x_start, x_end = y, x, x
+    result.append([row, x_start, x_end])
+    return result
+
+
+def naive_line(x0, y0, x1, y1, xs, ys):
+    if x0 == x1:
+        for y in range(y0, y1 + 1):
+            xs.append(x0)
+            ys.append(y)
+    else:
+        if x0 > x1:
+            x0, y0, x1, y1 = x1, y1, x0, y0
+        k = (y1 - y0) / (x1 - x0)
+        for x in range(x0, x1 + 1):
+            xs.append(x)
+            ys.append(int(y0 + k * (x - x0)))
+
+
+def dda_line(x0, y0, x1, y1, xs, ys):
+    length = max(abs(x1 - x0), abs(y1 - y0))
+    if length == 0:
+        xs += [x0, x1]
+        ys += [y0, y1]
+        return
+    dx = (x1 - x0) / length
+    dy = (y1 - y0) / length
+    x = x0 + 0.5
+    y = y0 + 0.5
+    for i in range(1, length + 1):
+        xs.append(int(x))
+        ys.append(int(y))
+        x = x + dx
+        y = y + dy
+
+
+def bresenham_line(x0, y0, x1, y1, xs, ys):
+    x = x0
+    y = y0
+    dx = abs(x1 - x)
+    dy = abs(y1 - y)
+    s1 = sign(x1 - x0)
+    s2 = sign(y1 - y0)
+    if dy > dx:
+        tmp = dx
+        dx = dy
+        dy = tmp
+        interchange = 1
+    else:
+        interchange = 0
+    e = 2 * dy - dx
+    for i in range(0, dx):
+        xs.append(int(x))
+        ys.append(int(y))
+        while e > 0:
             if interchange:
-                y = y + s2
-            else:
                 x = x + s1
-            e = e + 2 * dy
+            else:
+                y = y + s2
+            e = e - 2 * dx
+        if interchange:
+            y = y + s2
+        else:
+            x = x + s1
+        e = e + 2 * dy
+
+
+# 各线段算法的核心循环，统一把像素坐标追加到扁平的 xs、ys 列表中
+LINE_KERNELS = {
+    'Naive': naive_line,
+    'DDA': dda_line,
+    'Bresenham': bresenham_line,
+}
+
+
+def draw_lines(segments, algorithm):
+    """批量绘制线段
+
+    :param segments: (list of list of list of int: [[[x0, y0], [x1, y1]], ...]) 多条线段的起点和终点坐标
+    :param algorithm: (string) 绘制使用的算法，包括'DDA'和'Bresenham'
+    :return: (tuple of list of int: (xs, ys)) 所有线段像素点的x坐标列表和y坐标列表，与逐条调用draw_line的结果逐像素一致
+    """
+    xs = []
+    ys = []
+    kernel = LINE_KERNELS[algorithm]
+    for (x0, y0), (x1, y1) in segments:
+        kernel(x0, y0, x1, y1, xs, ys)
+    return xs, ys
 
-    return result
 
+def polygon_edges(p_list):
+    """多边形的边列表，顺序与draw_polygon一致
 
-def draw_polygon(p_list, algorithm):
+    :param p_list: (list of list of int: [[x0, y0], [x1, y1], [x2, y2], ...]) 多边形的顶点坐标列表
+    :return: (list of list of list of int: [[[x0, y0], [x1, y1]], ...]) 多边形各条边
+    """
+    return [[p_list[i - 1], p_list[i]] for i in range(len(p_list))]
+
+
+def draw_polygon(p_list, algorithm, spans=False):
     """绘制多边形
 
     :param p_list: (list of list of int: [[x0, y0], [x1, y1], [x2, y2], ...]) 多边形的顶点坐标列表
-    :param algorithm: (string) 绘制使用的算法，包括'DDA'和'Bresenham'
+    :param algorithm: (string) 绘制使用的算法，包括'DDA'和'Bresenham'，'Scanline'表示用扫描线算法填充多边形内部
+    :param spans: (bool) 为True时返回水平区段列表[[y, x_start, x_end], ...]而不是像素点坐标列表
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 绘制结果的像素点坐标列表
     """
     result = []
+    if spans:
+        if algorithm == 'Scanline':
+            return fill_polygon(p_list)
+        return run_length_spans(*draw_lines(polygon_edges(p_list), algorithm))
+    if algorithm == 'Scanline':
+        for y, x_start, x_end in fill_polygon(p_list):
+            result += [[x, y] for x in range(x_start, x_end + 1)]
+        return result
     for i in range(len(p_list)):
         line = draw_line([p_list[i - 1], p_list[i]], algorithm)
         result += line
     return result
 
 
-def draw_ellipse(p_list):
+def fill_polygon(p_list):
+    """扫描线填充多边形（边表 + 活性边表）
+
+    边表按边的较小y坐标分桶，扫描到该行时把边移入活性边表，扫描到边的较大y坐标时移出；
+    每条扫描线上活性边的交点排序后两两配对，得到一个水平区段。
+    扫描线采用上闭下开的规则，区段取交点之间（含端点）的整数像素，相邻多边形的公共边不会被重复填充
+
+    :param p_list: (list of list of int: [[x0, y0], [x1, y1], [x2, y2], ...]) 多边形的顶点坐标列表
+    :return: (list of list of int: [[y, x_start, x_end], ...]) 按扫描线从上到下排列的水平区段，x_start和x_end都包含在内
+    """
+    edge_table = {}
+    for (x0, y0), (x1, y1) in polygon_edges(p_list):
+        if y0 == y1:
+            continue
+        if y0 > y1:
+            x0, y0, x1, y1 = x1, y1, x0, y0
+        # [起点x, 起点y, dx, dy, 终点y]，交点横坐标 x0 + (y - y0) * dx / dy 用整数分子分母精确表示
+        edge_table.setdefault(y0, []).append([x0, y0, x1 - x0, y1 - y0, y1])
+    result = []
+    active = []
+    y = 0
+    while edge_table or active:
+        if not active:
+            y = min(edge_table)
+        active += edge_table.pop(y, [])
+        crossings = sorted(((x0 * dy + (y - y0) * dx, dy) for x0, y0, dx, dy, _ in active),
+                           key=lambda c: c[0] / c[1])
+        for i in range(0, len(crossings) - 1, 2):
+            x_start = -(-crossings[i][0] // crossings[i][1])
+            x_end = crossings[i + 1][0] // crossings[i + 1][1]
+            if x_start > x_end:
+                continue
+            if result and result[-1][0] == y and x_start <= result[-1][2]:
+                # 交点重合在顶点上时，相邻两个区段合并为一个
+                result[-1][2] = max(result[-1][2], x_end)
+            else:
+                result.append([y, x_start, x_end])
+        y += 1
+        active = [e for e in active if e[4] > y]
+    return result
+
+
+def draw_ellipse(p_list, spans=False):
     """绘制椭圆（采用中点圆生成算法）
 
     :param p_list: (list of list of int: [[x0, y0], [x1, y1]]) 椭圆的矩形包围框左上角和右下角顶点坐标
+    :param spans: (bool) 为True时返回水平区段列表[[y, x_start, x_end], ...]而不是像素点坐标列表
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 绘制结果的像素点坐标列表
     """
-    x0, y0 = p_list[0]
-    x1, y1 = p_list[1]
+    xs, ys = draw_ellipses([p_list])
+    if spans:
+        # draw_ellipses的结果中四个象限的点交错排列，按象限分别压缩
+        result = []
+        for q in range(4):
+            result += run_length_spans(xs[q::4], ys[q::4])
+        return result
+    return [[x, y] for x, y in zip(xs, ys)]
 
-    rx = abs(x1 - x0) / 2
-    ry = abs(y1 - y0) / 2
-    cx = abs(x1 + x0) / 2
-    cy = abs(y1 + y0) / 2
 
-    rx2 = rx * rx
-    ry2 = ry * ry
+def draw_ellipses(rects):
+    """批量绘制椭圆（整数运算的中点椭圆生成算法）
 
-    x = 0
-    y = int(ry + 0.5)
+    半轴长 rx = a / 2、ry = b / 2 可能是半整数，把判别式乘以16后全部化为整数运算；
+    每得到第一象限的一个点，就把它的四个对称点连同中心偏移一起写入预先分配的坐标数组
 
-    result = []
-    p1 = ry2 - rx2 * ry + rx2 / 4
-    while ry2 * x < rx2 * y:
-        result.append([int(x), int(y)])
-        x = x + 1
-        if p1 > 0:
-            y = y - 1
-            p1 = p1 - 2 * rx2 * y
-        p1 = p1 + 2 * ry2 * x + ry2
-
-    p2 = ry2 * ((x + 0.5) ** 2) + rx2 * ((y - 1) ** 2) - rx2 * ry2
-
-    while y >= 0:
-        result.append([int(x), int(y)])
-        y = y - 1
-        if p2 < 0:
-            x = x + 1
-            p2 = p2 + 2 * ry2 * x
-        p2 = p2 - 2 * rx2 * y + rx2
-
-    for i in range(len(result)):
-        result.append([-result[i][0], -result[i][1]])
-        result.append([-result[i][0], result[i][1]])
-        result.append([result[i][0], -result[i][1]])
-
-    for i in range(len(result)):
-        result[i][0] = int(result[i][0] + cx)
-        result[i][1] = int(result[i][1] + cy)
-
-    return result
+    :param rects: (list of list of list of int: [[[x0, y0], [x1, y1]], ...]) 各椭圆的矩形包围框对角顶点坐标
+    :return: (tuple of list of int: (xs, ys)) 所有椭圆像素点的x坐标列表和y坐标列表
+    """
+    # 第一象限的点数约为 rx + ry，不足时再按同样的步长扩容
+    grow = 4 * sum((abs(x1 - x0) + abs(y1 - y0)) // 2 + 2 for (x0, y0), (x1, y1) in rects)
+    size = grow
+    xs = [0] * size
+    ys = [0] * size
+    k = 0
+    for (x0, y0), (x1, y1) in rects:
+        a = abs(x1 - x0)
+        b = abs(y1 - y0)
+        aa = a * a
+        bb = b * b
+        # 中心坐标的两倍
+        cx2 = abs(x1 + x0)
+        cy2 = abs(y1 + y0)
+        x = 0
+        y = (b + 1) // 2
+        p = 4 * bb - 2 * aa * b + aa
+        region1 = True
+        while True:
+            if region1:
+                if bb * x >= aa * y:
+                    region1 = False
+                    p = bb * (2 * x + 1) ** 2 + 4 * aa * (y - 1) ** 2 - aa * bb
+                    continue
+            elif y < 0:
+                break
+
+            if k == size:
+                xs += [0] * grow
+                ys += [0] * grow
+                size += grow
+            # (t + (t < 0)) >> 1 等价于 int(t / 2)
+            t = cx2 + 2 * x
+            xr = (t + (t < 0)) >> 1
+            t = cx2 - 2 * x
+            xl = (t + (t < 0)) >> 1
+            t = cy2 + 2 * y
+            yb = (t + (t < 0)) >> 1
+            t = cy2 - 2 * y
+            yt = (t + (t < 0)) >> 1
+            xs[k] = xr
+            ys[k] = yb
+            xs[k + 1] = xl
+            ys[k + 1] = yt
+            xs[k + 2] = xl
+            ys[k + 2] = yb
+            xs[k + 3] = xr
+            ys[k + 3] = yt
+            k += 4
+
+            if region1:
+                x = x + 1
+                if p > 0:
+                    y = y - 1
+                    p = p - 8 * aa * y
+                p = p + 8 * bb * x + 4 * bb
+            else:
+                y = y - 1
+                if p < 0:
+                    x = x + 1
+                    p = p + 8 * bb * x
+                p = p - 8 * aa * y + 4 * aa
+    del xs[k:]
+    del ys[k:]
+    return xs, ys
 
 
-def get_st(p_list):
-    st = []
-    x_list = []
-    y_list = []
-    for i in p_list:
-        x_list.append(i[0])
-        y_list.append(i[1])
-    dx = max(x_list) - min(x_list)
-    dy = max(y_list) - min(y_list)
-    du = 0.01 / max(dx, dy)
-    st = []
-    i = 0
-    while i <= 1:
-        st.append(i)
-        i = i + du
-    return st
-
-
-def bezier(p_list):
-    result = []
-    tmp_point = []
-    length = len(p_list)
-    for u in get_st(p_list):
-        for i in p_list:
-            tmp_point.append([i[0], i[1]])
+def ellipse_extent(p_list):
+    """draw_ellipses结果的范围
 
-        for i in range(length):
-            for j in range(length - i - 1):
-                tmp_point[j][0] = (1 - u)*tmp_point[j][0] + u*tmp_point[j + 1][0]
-                tmp_point[j][1] = (1 - u) * tmp_point[j][1] + u * tmp_point[j + 1][1]
+    与draw_ellipses一致，中心取 |x0 + x1| / 2 而不是包围框的中点；
+    b为奇数时算法从y = (b + 1) / 2起步，x方向最多多走出约 a / 2b
 
-        result.append([int(tmp_point[j][0]), int(tmp_point[j][1])])
+    :param p_list: (list of list of int: [[x0, y0], [x1, y1]]) 椭圆的矩形包围框对角顶点坐标
+    :return: (tuple of int: (cx2, cy2, rx, ry)) 中心坐标的两倍，以及像素到中心的最大水平、竖直距离的上界
+    """
+    (x0, y0), (x1, y1) = p_list
+    a = abs(x1 - x0)
+    b = abs(y1 - y0)
+    return abs(x0 + x1), abs(y0 + y1), a * (b + 1) // (2 * max(b, 1)) + 2, b // 2 + 2
 
-    return result
 
+def adaptive_samples(point_at, min_steps=1, connected=False):
+    """自适应细分参数区间[0, 1]并采样曲线，使相邻采样点落在相邻像素上
 
-def special_div(a, b):
-    if a == 0 and b == 0:
-        return 0
-    else:
-        return a/b
+    按深度优先顺序二分区间，栈中只保存区间右端点，工作内存与细分深度成正比
 
+    :param point_at: (callable: u -> (float, float)) 曲线在参数u处的坐标
+    :param min_steps: (int) 最少均匀划分的区间数，防止首末点重合的闭合曲线被直接跳过
+    :param connected: (bool) 为True时返回8连通的像素路径：去掉拐角处多余的像素，并用直线补上达到细分深度上限后仍存在的缺口
+    :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 按参数顺序排列、相邻不重复的像素点坐标列表
+    """
+    max_du = 1 / min_steps
+    u0 = 0
+    x0, y0 = point_at(0)
+    result = [[int(x0), int(y0)]]
+    stack = [(1, *point_at(1))]
+    while stack:
+        u1, x1, y1 = stack[-1]
+        du = u1 - u0
+        if du > 1e-9 and (du > max_du or abs(x1 - x0) > 1 or abs(y1 - y0) > 1):
+            um = (u0 + u1) / 2
+            stack.append((um, *point_at(um)))
+            continue
+        stack.pop()
+        u0, x0, y0 = u1, x1, y1
+        append_pixel(result, int(x1), int(y1), connected)
+    return result
 
-def deboox_cox(u, i, k, un):
-    if k == 1:
-        if un[i] <= u < un[i + 1]:
-            return 1
-        else:
-            return 0
-    else:
-        c1 = special_div(u-un[i], un[i+k-1]-un[i])
-        c2 = special_div(un[i+k]-u, un[i+k]-un[i+1])
-        return c1 * deboox_cox(u, i, k-1, un) + c2 * deboox_cox(u, i+1, k-1, un)
 
+def append_pixel(result, px, py, connected):
+    """把曲线上的下一个像素追加到像素路径末尾，跳过与末尾重复的像素
 
-def b_spline(p_list):
+    :param connected: (bool) 为True时保持路径8连通且无拐角冗余像素
+    """
+    if not result:
+        result.append([px, py])
+        return
+    last = result[-1]
+    if last[0] == px and last[1] == py:
+        return
+    if connected:
+        if abs(px - last[0]) > 1 or abs(py - last[1]) > 1:
+            xs = []
+            ys = []
+            bresenham_line(last[0], last[1], px, py, xs, ys)
+            result += [[x, y] for x, y in zip(xs[1:], ys[1:])]
+        elif len(result) > 1 and abs(px - result[-2][0]) <= 1 and abs(py - result[-2][1]) <= 1:
+            result.pop()
+    result.append([px, py])
+
+
+def bezier(p_list, connected=False):
+    length = len(p_list)
+    px = [p[0] for p in p_list]
+    py = [p[1] for p in p_list]
+    # de Casteljau算法的工作区，每次求值前重新填入控制点
+    bx = px[:]
+    by = py[:]
+
+    def point_at(u):
+        bx[:] = px
+        by[:] = py
+        v = 1 - u
+        for i in range(length - 1, 0, -1):
+            for j in range(i):
+                bx[j] = v * bx[j] + u * bx[j + 1]
+                by[j] = v * by[j] + u * by[j + 1]
+        return bx[0], by[0]
+
+    return adaptive_samples(point_at, 4 * max(length - 1, 1), connected)
+
+
+# 三次均匀B样条的基矩阵（已乘以6），每段曲线 P(t) = [t^3, t^2, t, 1] * M * [P_i, P_i+1, P_i+2, P_i+3] / 6
+B_SPLINE_MATRIX = (
+    (-1, 3, -3, 1),
+    (3, -6, 3, 0),
+    (-3, 0, 3, 0),
+    (1, 4, 1, 0),
+)
+
+
+def b_spline(p_list, connected=False):
+    """三次均匀B样条曲线，逐段用基矩阵求出多项式系数，再用向前差分求值
+
+    每段的采样数取相邻控制点间距的最大值（切比雪夫距离），它是该段曲线导数的上界，
+    因此相邻采样点之间的距离不超过1像素；曲线不经过首末控制点，控制点少于4个时不绘制
+    """
     result = []
-    k = 4
-    n = len(p_list)
-    un = []
-    du = 1 / (n+k-1)
-    for i in range(n+k):
-        un.append(du * i)
-
-    du = 0.001
-    u = un[k-1]
-    while u <= un[n]:
-        x, y = 0, 0
-        for i in range(n):
-            b = deboox_cox(u, i, k, un)
-            x += p_list[i][0] * b
-            y += p_list[i][1] * b
-        result.append([int(x), int(y)])
-        u = u+0.001
-
+    x = y = 0
+    for i in range(len(p_list) - 3):
+        seg = p_list[i:i + 4]
+        ax, bx, cx, dx = [sum(m * p[0] for m, p in zip(row, seg)) / 6 for row in B_SPLINE_MATRIX]
+        ay, by, cy, dy = [sum(m * p[1] for m, p in zip(row, seg)) / 6 for row in B_SPLINE_MATRIX]
+        steps = max(1, max(max(abs(q[0] - p[0]), abs(q[1] - p[1])) for p, q in zip(seg, seg[1:])))
+        h = 1 / steps
+        h2 = h * h
+        h3 = h2 * h
+        x, dx1, dx2, dx3 = dx, ax * h3 + bx * h2 + cx * h, 6 * ax * h3 + 2 * bx * h2, 6 * ax * h3
+        y, dy1, dy2, dy3 = dy, ay * h3 + by * h2 + cy * h, 6 * ay * h3 + 2 * by * h2, 6 * ay * h3
+        for k in range(steps):
+            append_pixel(result, int(x), int(y), connected)
+            x += dx1
+            dx1 += dx2
+            dx2 += dx3
+            y += dy1
+            dy1 += dy2
+            dy2 += dy3
+        x = ax + bx + cx + dx
+        y = ay + by + cy + dy
+    if len(p_list) >= 4:
+        append_pixel(result, int(x), int(y), connected)
     return result
 
 
-def draw_curve(p_list, algorithm):
+def draw_curve(p_list, algorithm, connected=False, spans=False):
     """绘制曲线
 
     :param p_list: (list of list of int: [[x0, y0], [x1, y1], [x2, y2], ...]) 曲线的控制点坐标列表
     :param algorithm: (string) 绘制使用的算法，包括'Bezier'和'B-spline'（三次均匀B样条曲线，曲线不必经过首末控制点）
+    :param connected: (bool) 为True时返回8连通、无重复的像素路径，否则返回自适应采样得到的像素点
+    :param spans: (bool) 为True时返回水平区段列表[[y, x_start, x_end], ...]而不是像素点坐标列表
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 绘制结果的像素点坐标列表
 
     """
     if algorithm == 'Bezier':
-        return bezier(p_list)
+        result = bezier(p_list, connected)
     else:
-        return b_spline(p_list)
+        result = b_spline(p_list, connected)
+    if spans:
+        return run_length_spans([p[0] for p in result], [p[1] for p in result])
+    return result
+
+
+# 仿射变换统一用齐次坐标下的3x3矩阵表示，((a, b, c), (d, e, f), (0, 0, 1))，
+# 把点(x, y)变换为(a * x + b * y + c, d * x + e * y + f)
+IDENTITY_MATRIX = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+
+
+def translate_matrix(dx, dy):
+    return (1, 0, dx), (0, 1, dy), (0, 0, 1)
+
+
+def rotate_matrix(x, y, r):
+    r = math.radians(r)
+    cr = math.cos(r)
+    sr = math.sin(r)
+    return (cr, -sr, x - x * cr + y * sr), (sr, cr, y - x * sr - y * cr), (0, 0, 1)
+
+
+def scale_matrix(x, y, s):
+    return (s, 0, x * (1 - s)), (0, s, y * (1 - s)), (0, 0, 1)
+
+
+def compose_matrix(m2, m1):
+    """复合两个仿射变换，得到先做m1再做m2的变换矩阵 m2 * m1"""
+    return tuple(
+        tuple(sum(m2[i][k] * m1[k][j] for k in range(3)) for j in range(3))
+        for i in range(3)
+    )
+
+
+def to_int(v):
+    """截断为整数；与整数相差不到1e-9的值视为该整数，避免矩阵中平移分量相消带来的误差把225算成224"""
+    r = round(v)
+    if abs(v - r) < 1e-9:
+        return r
+    return int(v)
+
+
+def transform_points(p_list, matrix):
+    """对图元参数应用仿射变换，结果截断为整数
+
+    :param p_list: (list of list of int: [[x0, y0], [x1, y1], [x2, y2], ...]) 图元参数
+    :param matrix: (tuple of tuple of float) 3x3仿射变换矩阵
+    :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 变换后的图元参数
+    """
+    (a, b, c), (d, e, f), _ = matrix
+    return [[to_int(a * x0 + b * y0 + c), to_int(d * x0 + e * y0 + f)] for x0, y0 in p_list]
 
 
 def translate(p_list, dx, dy):
@@ -235,11 +508,7 @@ def translate(p_list, dx, dy):
     :param dy: (int) 垂直方向平移量
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 变换后的图元参数
     """
-    result = []
-    for i in range(len(p_list)):
-        result.append([p_list[i][0] + dx, p_list[i][1] + dy])
-
-    return result
+    return transform_points(p_list, translate_matrix(dx, dy))
 
 
 def rotate(p_list, x, y, r):
@@ -252,18 +521,7 @@ def rotate(p_list, x, y, r):
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 变换后的图元参数
 
     """
-    r = math.radians(r)
-    cr = math.cos(r)
-    sr = math.sin(r)
-    result = []
-
-    for i in range(len(p_list)):
-        x0, y0 = p_list[i]
-        x1 = x + (x0 - x) * cr - (y0 - y) * sr
-        y1 = y + (x0 - x) * sr + (y0 - y) * cr
-        result.append([int(x1), int(y1)])
-
-    return result
+    return transform_points(p_list, rotate_matrix(x, y, r))
 
 
 def scale(p_list, x, y, s):
@@ -275,23 +533,90 @@ def scale(p_list, x, y, s):
     :param s: (float) 缩放倍数
     :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 变换后的图元参数
     """
-    result = []
-    for i in range(len(p_list)):
-        x0, y0 = p_list[i]
-        x1 = x0 * s + x * (1 - s)
-        y1 = y0 * s + y * (1 - s)
-        result.append([int(x1), int(y1)])
+    return transform_points(p_list, scale_matrix(x, y, s))
 
-    return result
+
+def pos_code(x, y, x_min, y_min, x_max, y_max):
+    """Cohen-Sutherland区域编码：1左 2右 4上 8下"""
+    return (x < x_min) | (x > x_max) << 1 | (y < y_min) << 2 | (y > y_max) << 3
 
 
-def get_pos_code(x, y, x_min, x_max, y_min, y_max):
-    pos = 0
-    pos = pos + (1 if x < x_min else 0)
-    pos = pos + (2 if x > x_max else 0)
-    pos = pos + (4 if y < y_min else 0)
-    pos = pos + (8 if y > y_max else 0)
-    return pos
+def round_half_up(v):
+    """四舍五入到整数，负数也向上取整半个像素（int(v + 0.5)对负数是向零截断）"""
+    return math.floor(v + 0.5)
+
+
+def cohen_sutherland(x0, y0, x1, y1, x_min, y_min, x_max, y_max):
+    """Cohen-Sutherland裁剪单条线段，整条线段被舍弃时返回None
+
+    移动后的端点在循环中保持浮点数，交点都按原线段计算，返回前才取整；
+    逐步取整会让端点偏离原线段，使从窗口外经过的线段被误判为与窗口相交
+    """
+    sx, sy = x0, y0
+    dx = x1 - x0
+    dy = y1 - y0
+    pos0 = pos_code(x0, y0, x_min, y_min, x_max, y_max)
+    pos1 = pos_code(x1, y1, x_min, y_min, x_max, y_max)
+    while 1:
+        if pos0 | pos1 == 0:
+            break
+        elif pos0 & pos1 != 0:
+            return None
+        if pos0 == 0:
+            x0, x1 = x1, x0
+            y0, y1 = y1, y0
+            pos0, pos1 = pos1, pos0
+        if pos0 & 1:
+            y0 = sy + (x_min - sx) * dy / dx
+            x0 = x_min
+        elif pos0 & 2:
+            y0 = sy + (x_max - sx) * dy / dx
+            x0 = x_max
+        elif pos0 & 4:
+            x0 = sx + (y_min - sy) * dx / dy
+            y0 = y_min
+        elif pos0 & 8:
+            x0 = sx + (y_max - sy) * dx / dy
+            y0 = y_max
+        pos0 = pos_code(x0, y0, x_min, y_min, x_max, y_max)
+    return [[round_half_up(x0), round_half_up(y0)], [round_half_up(x1), round_half_up(y1)]]
+
+
+def liang_barsky(x0, y0, x1, y1, x_min, y_min, x_max, y_max):
+    """Liang-Barsky裁剪单条线段，整条线段被舍弃时返回None
+
+    四条边界 p = [-dx, dx, -dy, dy]，q = [x0 - x_min, x_max - x0, y0 - y_min, y_max - y0] 直接展开计算
+    """
+    dx = x1 - x0
+    dy = y1 - y0
+    u0 = 0
+    u1 = 1
+    if dx > 0:
+        u0 = max((x0 - x_min) / -dx, u0)
+        u1 = min((x_max - x0) / dx, u1)
+    elif dx < 0:
+        u1 = min((x0 - x_min) / -dx, u1)
+        u0 = max((x_max - x0) / dx, u0)
+    elif x0 < x_min or x0 > x_max:
+        return None
+    if dy > 0:
+        u0 = max((y0 - y_min) / -dy, u0)
+        u1 = min((y_max - y0) / dy, u1)
+    elif dy < 0:
+        u1 = min((y0 - y_min) / -dy, u1)
+        u0 = max((y_max - y0) / dy, u0)
+    elif y0 < y_min or y0 > y_max:
+        return None
+    if u0 > u1:
+        return None
+    return [[round_half_up(x0 + u0 * dx), round_half_up(y0 + u0 * dy)],
+            [round_half_up(x0 + u1 * dx), round_half_up(y0 + u1 * dy)]]
+
+
+CLIP_KERNELS = {
+    'Cohen-Sutherland': cohen_sutherland,
+    'Liang-Barsky': liang_barsky,
+}
 
 
 def clip(p_list, x_min, y_min, x_max, y_max, algorithm):
@@ -303,53 +628,110 @@ def clip(p_list, x_min, y_min, x_max, y_max, algorithm):
     :param x_max: 裁剪窗口右下角x坐标
     :param y_max: 裁剪窗口右下角y坐标
     :param algorithm: (string) 使用的裁剪算法，包括'Cohen-Sutherland'和'Liang-Barsky'
-    :return: (list of list of int: [[x_0, y_0], [x_1, y_1]]) 裁剪后线段的起点和终点坐标
+    :return: (list of list of int: [[x_0, y_0], [x_1, y_1]]) 裁剪后线段的起点和终点坐标，线段被整体舍弃时为[[0, 0], [0, 0]]
     """
     x0, y0 = p_list[0]
     x1, y1 = p_list[1]
-    if algorithm == 'Cohen-Sutherland':
-        while 1:
-            pos0 = get_pos_code(x0, y0, x_min, x_max, y_min, y_max)
-            pos1 = get_pos_code(x1, y1, x_min, x_max, y_min, y_max)
-            if pos0 | pos1 == 0:
-                return [[x0, y0], [x1, y1]]
-            elif pos0 & pos1 != 0 or pos0 == pos1:
-                return [[0, 0], [0, 0]]
-            else:
-                if pos0 == 0:
-                    x0, x1 = x1, x0
-                    y0, y1 = y1, y0
-                if pos0 & 1:
-                    y0 = int(y0 + ((x_min - x0) * (y0-y1)/(x0-x1)) + 0.5)
-                    x0 = x_min
-                if pos0 & 2:
-                    y0 = int(y0 + ((x_max - x0) * (y0-y1)/(x0-x1)) + 0.5)
-                    x0 = x_max
-                if pos0 & 4:
-                    x0 = int(x0 + ((y_min - y0) * (x0-x1)/(y0-y1)) + 0.5)
-                    y0 = y_min
-                if pos0 & 8:
-                    x0 = int(x0 + ((y_max - y0) * (x0-x1)/(y0-y1)) + 0.5)
-                    y0 = y_max
+    result = CLIP_KERNELS[algorithm](x0, y0, x1, y1, x_min, y_min, x_max, y_max)
+    if result is None:
+        return [[0, 0], [0, 0]]
+    return result
 
-    else:
-        dx = x1 - x0
-        dy = y1 - y0
-        u0 = 0
-        u1 = 1
-        p = [-dx, dx, -dy, dy]
-        q = [x0-x_min, x_max-x0, y0-y_min, y_max-y0]
-        for i in range(4):
-            if u0 > u1:
-                return [[0, 0], [0, 0]]
+
+def clip_lines(segments, x_min, y_min, x_max, y_max, algorithm):
+    """用同一个裁剪窗口批量裁剪线段
+
+    先一次性计算所有端点的区域编码，完全在窗口内的线段直接保留、两端点在窗口同一外侧的直接舍弃，
+    只有跨越窗口边界的线段才交给裁剪算法逐条处理
+
+    :param segments: (list of list of list of int: [[[x0, y0], [x1, y1]], ...]) 线段列表
+    :param x_min: 裁剪窗口左上角x坐标
+    :param y_min: 裁剪窗口左上角y坐标
+    :param x_max: 裁剪窗口右下角x坐标
+    :param y_max: 裁剪窗口右下角y坐标
+    :param algorithm: (string) 使用的裁剪算法，包括'Cohen-Sutherland'和'Liang-Barsky'
+    :return: (tuple: (kept, rejected)) kept为未被舍弃的线段按原顺序排列的裁剪结果，
+        rejected为与segments等长的布尔列表，标记整条被舍弃的线段
+    """
+    codes = [(pos_code(x0, y0, x_min, y_min, x_max, y_max), pos_code(x1, y1, x_min, y_min, x_max, y_max))
+             for (x0, y0), (x1, y1) in segments]
+    kernel = CLIP_KERNELS[algorithm]
+    kept = []
+    rejected = [False] * len(segments)
+    for i, (pos0, pos1) in enumerate(codes):
+        (x0, y0), (x1, y1) = segments[i]
+        if pos0 | pos1 == 0:
+            kept.append([[x0, y0], [x1, y1]])
+        elif pos0 & pos1 != 0:
+            rejected[i] = True
+        else:
+            result = kernel(x0, y0, x1, y1, x_min, y_min, x_max, y_max)
+            if result is None:
+                rejected[i] = True
             else:
-                if p[i] < 0:
-                    u0 = max(q[i]/p[i], u0)
-                elif p[i] > 0:
-                    u1 = min(q[i]/p[i], u1)
-                elif q[i] < 0:
-                    return [[0, 0], [0, 0]]
-        return [[int(x0+u0*dx+0.5), int(y0+u0*dy+0.5)], [int(x0+u1*dx+0.5), int(y0+u1*dy+0.5)]]
+                kept.append(result)
+    return kept, rejected
+
+
+def sutherland_hodgman_stage(vertices, axis, bound, side):
+    """Sutherland-Hodgman算法中用一条裁剪边界处理顶点流的一级流水线
+
+    逐个读入上一级输出的顶点，只记住首个顶点和前一个顶点，不构造中间顶点列表
+
+    :param vertices: (iterable of tuple of float) 上一级输出的顶点流
+    :param axis: (int) 0表示竖直边界 x = bound，1表示水平边界 y = bound
+    :param bound: (int) 边界坐标
+    :param side: (int) 1表示坐标不小于bound的一侧在窗口内，-1表示不大于bound的一侧在窗口内
+    """
+    first = prev = None
+    prev_in = False
+    for v in vertices:
+        v_in = (v[axis] - bound) * side >= 0
+        if first is None:
+            first = v
+            first_in = v_in
+        elif v_in != prev_in:
+            yield boundary_intersection(prev, v, axis, bound)
+        if v_in:
+            yield v
+        prev = v
+        prev_in = v_in
+    if first is not None and first_in != prev_in:
+        yield boundary_intersection(prev, first, axis, bound)
+
+
+def boundary_intersection(s, e, axis, bound):
+    t = (bound - s[axis]) / (e[axis] - s[axis])
+    if axis == 0:
+        return bound, s[1] + t * (e[1] - s[1])
+    return s[0] + t * (e[0] - s[0]), bound
+
+
+def clip_polygon(p_list, x_min, y_min, x_max, y_max):
+    """多边形裁剪（Sutherland-Hodgman算法）
+
+    顶点依次流过左、右、上、下四级裁剪流水线，最后四舍五入为整数并去掉相邻的重复顶点
+
+    :param p_list: (list of list of int: [[x0, y0], [x1, y1], [x2, y2], ...]) 多边形的顶点坐标列表
+    :param x_min: 裁剪窗口左上角x坐标
+    :param y_min: 裁剪窗口左上角y坐标
+    :param x_max: 裁剪窗口右下角x坐标
+    :param y_max: 裁剪窗口右下角y坐标
+    :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 裁剪后多边形的顶点坐标列表，完全在窗口外时为空列表
+    """
+    vertices = (tuple(p) for p in p_list)
+    vertices = sutherland_hodgman_stage(vertices, 0, x_min, 1)
+    vertices = sutherland_hodgman_stage(vertices, 0, x_max, -1)
+    vertices = sutherland_hodgman_stage(vertices, 1, y_min, 1)
+    vertices = sutherland_hodgman_stage(vertices, 1, y_max, -1)
+    result = []
+    for x, y in vertices:
+        p = [round_half_up(x), round_half_up(y)]
+        if not result or result[-1] != p:
+            result.append(p)
+    if len(result) > 1 and result[0] == result[-1]:
+        result.pop()
+    return result
 
 
 def sign(x):
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 性能基准：生成参数化的工作负载，测量cg_algorithms各算法和cg_cli解释器的吞吐量、延迟分位数和峰值内存，
+# 结果写成JSON，便于在不同版本之间对比
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import cg_algorithms as alg
+import cg_parser as cmd
+import cg_cli
+
+CANVAS_SIZE = 1000
+
+
+def random_point(rng):
+    return [rng.randint(0, CANVAS_SIZE - 1), rng.randint(0, CANVAS_SIZE - 1)]
+
+
+def line_cases(rng, scale):
+    """每种算法N条随机线段"""
+    segments = [[random_point(rng), random_point(rng)] for _ in range(200 * scale)]
+    for algorithm in ('DDA', 'Bresenham'):
+        yield 'line/' + algorithm, [(alg.draw_line, (p_list, algorithm)) for p_list in segments]
+
+
+def polygon_cases(rng, scale):
+    """顶点很多的多边形，分别描边和填充；顶点落在300×300的范围内，避免填充结果过大"""
+    for vertices, count in ((8, 10), (64, 4), (512, 1)):
+        polygons = []
+        for _ in range(count * scale):
+            x, y = random_point(rng)
+            polygons.append([[x + rng.randint(-150, 150), y + rng.randint(-150, 150)] for _ in range(vertices)])
+        for algorithm in ('Bresenham', 'Scanline'):
+            yield 'polygon/%s/%d' % (algorithm, vertices), \
+                [(alg.draw_polygon, (p_list, algorithm)) for p_list in polygons]
+
+
+def ellipse_cases(rng, scale):
+    """不同半径的椭圆"""
+    for radius in (10, 100, 450):
+        rects = []
+        for _ in range(50 * scale):
+            cx, cy = rng.randint(radius, CANVAS_SIZE - radius), rng.randint(radius, CANVAS_SIZE - radius)
+            rx, ry = rng.randint(1, radius), rng.randint(1, radius)
+            rects.append([[cx - rx, cy - ry], [cx + rx, cy + ry]])
+        yield 'ellipse/%d' % radius, [(alg.draw_ellipse, (p_list,)) for p_list in rects]
+
+
+def curve_cases(rng, scale):
+    """3到100个控制点的Bezier和B样条曲线"""
+    for points, count in ((3, 20), (10, 10), (30, 3), (100, 1)):
+        curves = [[random_point(rng) for _ in range(points)] for _ in range(count * scale)]
+        for algorithm in ('Bezier', 'B-spline'):
+            if algorithm == 'B-spline' and points < 4:
+                # 三次B样条至少需要4个控制点
+                continue
+            yield 'curve/%s/%d' % (algorithm, points), [(alg.draw_curve, (p_list, algorithm)) for p_list in curves]
+
+
+def transform_chain(p_list, steps, seed):
+    """在图元上累积steps次随机平移、旋转和缩放，最后一次性作用到控制点上"""
+    rng = random.Random(seed)
+    matrix = alg.IDENTITY_MATRIX
+    for _ in range(steps):
+        op = rng.random()
+        if op < 0.4:
+            step = alg.translate_matrix(rng.randint(-20, 20), rng.randint(-20, 20))
+        elif op < 0.8:
+            step = alg.rotate_matrix(CANVAS_SIZE // 2, CANVAS_SIZE // 2, rng.randint(-180, 180))
+        else:
+            step = alg.scale_matrix(CANVAS_SIZE // 2, CANVAS_SIZE // 2, rng.choice([0.5, 0.9, 1.1, 2]))
+        matrix = alg.compose_matrix(step, matrix)
+    return alg.transform_points(p_list, matrix)
+
+
+def transform_cases(rng, scale):
+    """很长的变换链"""
+    for steps in (10, 1000):
+        polygons = [[random_point(rng) for _ in range(16)] for _ in range(20 * scale)]
+        yield 'transform/%d' % steps, [(transform_chain, (p_list, steps, i))
+                                       for i, p_list in enumerate(polygons)]
+
+
+# 工作负载名 -> (生成 (用例名, [(函数, 参数), ...]) 的函数, 函数返回结果的单位)
+ALGORITHM_WORKLOADS = {
+    'line': (line_cases, 'pixels'),
+    'polygon': (polygon_cases, 'pixels'),
+    'ellipse': (ellipse_cases, 'pixels'),
+    'curve': (curve_cases, 'pixels'),
+    'transform': (transform_cases, 'points'),
+}
+
+
+def percentiles(samples):
+    """:return: (dict) 毫秒为单位的p50、p90、p99和最大值"""
+    samples = sorted(samples)
+    result = {}
+    for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        result[name] = samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+    result['max'] = samples[-1] * 1000
+    return result
+
+
+def peak_memory(run):
+    """:return: (int) 在tracemalloc下运行一次run时Python分配内存的峰值（字节）"""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_calls(calls, repeat, unit='pixels'):
+    """逐个计时调用，统计吞吐量和单次调用延迟
+
+    :param calls: (list of tuple: [(函数, 参数), ...]) 用例
+    :param repeat: (int) 重复整组用例的次数
+    :param unit: (string) 函数返回的列表中每个元素的含义，吞吐量记为unit_per_sec
+    :return: (dict) 基准结果
+    """
+    latencies = []
+    outputs = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for function, args in calls:
+            t0 = time.perf_counter()
+            result = function(*args)
+            latencies.append(time.perf_counter() - t0)
+            outputs += len(result)
+    elapsed = time.perf_counter() - start
+
+    def run_once():
+        for function, args in calls:
+            function(*args)
+    return {
+        'calls': len(latencies),
+        'seconds': elapsed,
+        unit + '_per_sec': outputs / elapsed,
+        'calls_per_sec': len(latencies) / elapsed,
+        'latency_ms': percentiles(latencies),
+        'peak_bytes': peak_memory(run_once),
+    }
+
+
+def command_file(rng, items, saves, edits):
+    """生成一个指令文件：先绘制items个图元，再进行saves轮“修改edits个图元后保存”
+
+    :return: (list of string) 指令行
+    """
+    lines = ['resetCanvas %d %d' % (CANVAS_SIZE, CANVAS_SIZE)]
+    ids = []
+
+    def point_text(count):
+        return ' '.join('%d %d' % tuple(random_point(rng)) for _ in range(count))
+    for i in range(items):
+        lines.append('setColor %d %d %d' % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+        kind = rng.choice(['line', 'polygon', 'ellipse', 'curve', 'fill'])
+        item_id = '%s%d' % (kind, i)
+        if kind == 'line':
+            lines.append('drawLine %s %s %s' % (item_id, point_text(2), rng.choice(['DDA', 'Bresenham'])))
+        elif kind == 'polygon':
+            lines.append('drawPolygon %s %s %s' % (item_id, point_text(rng.randint(3, 8)),
+                                                   rng.choice(['DDA', 'Bresenham'])))
+        elif kind == 'ellipse':
+            lines.append('drawEllipse %s %s' % (item_id, point_text(2)))
+        elif kind == 'curve':
+            lines.append('drawCurve %s %s %s' % (item_id, point_text(rng.randint(3, 8)),
+                                                 rng.choice(['Bezier', 'B-spline'])))
+        else:
+            lines.append('fillPolygon %s %s' % (item_id, point_text(rng.randint(3, 8))))
+        ids.append(item_id)
+    for save in range(saves):
+        for _ in range(edits):
+            lines.append('translate %s %d %d' % (rng.choice(ids), rng.randint(-20, 20), rng.randint(-20, 20)))
+        lines.append('saveCanvas %d' % save)
+    return lines
+
+
+def cli_cases(rng, scale):
+    """完整的指令文件：少量保存的复杂场景，以及改动很少、保存很多次的场景"""
+    yield 'cli/scene', command_file(rng, 300 * scale, 5, 20)
+    yield 'cli/many_saves', command_file(rng, 50 * scale, 100, 2)
+
+
+def bench_cli(lines, repeat, cli_args):
+    """用cg_cli.Interpreter执行指令文件，统计指令吞吐量和每次saveCanvas的延迟"""
+    with tempfile.TemporaryDirectory() as output_dir:
+        input_file = os.path.join(output_dir, 'input.txt')
+        with open(input_file, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        commands = cmd.compile_file(input_file)
+        saves = []
+
+        def run_once(record):
+            # 重新构造解释器，避免上一轮的缓存影响结果
+            cg_cli.raster_cache.clear()
+            interpreter = cg_cli.Interpreter(output_dir, **cli_args)
+            save_canvas = interpreter.save_canvas
+
+            def timed_save(command):
+                t0 = time.perf_counter()
+                save_canvas(command)
+                if record:
+                    saves.append(time.perf_counter() - t0)
+            interpreter.dispatch[cmd.SAVE_CANVAS] = timed_save
+            interpreter.run(commands)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run_once(True)
+        elapsed = time.perf_counter() - start
+        return {
+            'commands': len(commands) * repeat,
+            'seconds': elapsed,
+            'commands_per_sec': len(commands) * repeat / elapsed,
+            'save_latency_ms': percentiles(saves),
+            'peak_bytes': peak_memory(lambda: run_once(False)),
+        }
+
+
+def run_benchmarks(workloads, scale=1, repeat=3, seed=0, cli_args=None):
+    """
+    :param workloads: (list of string) ALGORITHM_WORKLOADS中的名字，以及'cli'
+    :return: (dict) 可以直接写成JSON的基准结果
+    """
+    results = {}
+    for name in workloads:
+        rng = random.Random('%s-%d' % (name, seed))
+        if name == 'cli':
+            for case, lines in cli_cases(rng, scale):
+                results[case] = bench_cli(lines, repeat, cli_args or {})
+                report(case, results[case])
+        else:
+            cases, unit = ALGORITHM_WORKLOADS[name]
+            for case, calls in cases(rng, scale):
+                results[case] = bench_calls(calls, repeat, unit)
+                report(case, results[case])
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': scale,
+            'repeat': repeat,
+            'seed': seed,
+            'cli_args': cli_args or {},
+        },
+        'results': results,
+    }
+
+
+def throughput_key(result):
+    """:return: (string) 结果中表示吞吐量的键"""
+    for key in result:
+        if key.endswith('_per_sec') and key != 'calls_per_sec':
+            return key
+
+
+def report(case, result):
+    key = throughput_key(result)
+    throughput = '%12.0f %s/s' % (result[key], key[:-len('_per_sec')])
+    latency = result.get('latency_ms') or result['save_latency_ms']
+    print('%-28s %s  p50 %8.3fms  p99 %8.3fms  peak %7.1fMB' % (
+        case, throughput, latency['p50'], latency['p99'], result['peak_bytes'] / (1 << 20)))
+
+
+def compare(baseline, current):
+    """打印当前结果相对基线结果的吞吐量变化"""
+    for case, result in current['results'].items():
+        old = baseline['results'].get(case)
+        if old is None:
+            continue
+        key = throughput_key(result)
+        print('%-28s %+7.1f%%' % (case, (result[key] / old[key] - 1) * 100))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workloads', nargs='+', default=list(ALGORITHM_WORKLOADS) + ['cli'],
+                        choices=list(ALGORITHM_WORKLOADS) + ['cli'])
+    parser.add_argument('--scale', type=int, default=1, help='工作负载规模的倍数')
+    parser.add_argument('--repeat', type=int, default=3, help='每个用例重复的次数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1, help='传给cg_cli.Interpreter的进程数')
+    parser.add_argument('--output', help='结果JSON文件的路径')
+    parser.add_argument('--baseline', help='与之对比的基线结果JSON文件')
+    args = parser.parse_args()
+
+    bench = run_benchmarks(args.workloads, args.scale, args.repeat, args.seed, {'jobs': args.jobs})
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(bench, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            compare(json.load(fp), bench)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 直接写24位BMP文件：文件按最终大小创建并映射到内存，画布就是文件中的像素区，保存时不再复制和编码
+import os
+import mmap
+import struct
+import numpy as np
+from PIL import Image
+
+# 文件头14字节 + BITMAPINFOHEADER 40字节
+HEADER_SIZE = 54
+# 水平和垂直分辨率（像素/米），与Pillow默认的96 dpi一致
+PIXELS_PER_METER = 3780
+
+
+def row_stride(width):
+    """:return: (int) 每行像素占用的字节数，按4字节对齐"""
+    return (width * 3 + 3) & ~3
+
+
+def bmp_header(width, height):
+    """:return: (bytes) 与Pillow输出一致的24位自底向上BMP文件头"""
+    image_size = row_stride(width) * height
+    return struct.pack('<2sIHHI', b'BM', HEADER_SIZE + image_size, 0, 0, HEADER_SIZE) + \
+        struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, image_size,
+                    PIXELS_PER_METER, PIXELS_PER_METER, 0, 0)
+
+
+def pixel_view(buffer, width, height):
+    """把BMP文件内容上的像素区解释为画布
+
+    :param buffer: (buffer) 完整的BMP文件内容，至少HEADER_SIZE + row_stride(width) * height字节
+    :return: (numpy.ndarray) 形状为[height, width, 3]的RGB画布视图，行自顶向下；写入视图即写入文件中自底向上的BGR像素
+    """
+    rows = np.ndarray([height, row_stride(width)], np.uint8, buffer, HEADER_SIZE)
+    return rows[::-1, :width * 3].reshape(height, width, 3)[:, :, ::-1]
+
+
+class BmpFile:
+    """
+    按最终大小创建并映射到内存的BMP文件，pixels是可以直接绘制的画布视图。
+    文件先在同一目录下的临时文件中写好，publish时再用os.replace换到path，不会截断path上已有的、可能仍被映射着的文件。
+    Windows上不能改名仍被映射着的文件，因此publish先关闭映射，改名后再重新映射
+    """
+    def __init__(self, path, width, height):
+        self.path = path
+        self.temp_path = '%s.%d.tmp' % (path, os.getpid())
+        self.width = width
+        self.height = height
+        self.size = HEADER_SIZE + row_stride(width) * height
+        with open(self.temp_path, 'w+b') as fp:
+            fp.truncate(self.size)
+            self.mm = mmap.mmap(fp.fileno(), self.size)
+        self.mm[:HEADER_SIZE] = bmp_header(width, height)
+        self.pixels = pixel_view(self.mm, width, height)
+
+    def copy_from(self, other):
+        """整体复制另一个同样大小的BMP文件的内容"""
+        self.mm[:] = other.mm
+
+    def publish(self):
+        """把临时文件换到path并重新映射，之后通过新的pixels继续修改文件
+
+        调用前须释放pixels以外所有指向映射的视图，否则无法关闭映射
+        """
+        if self.temp_path is None:
+            return
+        self.pixels = None
+        self.mm.close()
+        os.replace(self.temp_path, self.path)
+        self.temp_path = None
+        with open(self.path, 'r+b') as fp:
+            self.mm = mmap.mmap(fp.fileno(), self.size)
+        self.pixels = pixel_view(self.mm, self.width, self.height)
+
+    def close(self):
+        self.pixels = None
+        self.mm.close()
+        if self.temp_path is not None:
+            os.replace(self.temp_path, self.path)
+            self.temp_path = None
+
+
+def is_bmp(path):
+    return os.path.splitext(path)[1].lower() == '.bmp'
+
+
+def save_image(canvas, path):
+    """保存画布，.bmp直接写文件头和像素，其余格式交给Pillow
+
+    :param canvas: (numpy.ndarray) 形状为[height, width, 3]的RGB画布
+    :param path: (string) 输出路径
+    """
+    height, width = canvas.shape[:2]
+    if not is_bmp(path) or width == 0 or height == 0:
+        Image.fromarray(canvas).save(path)
+        return
+    bmp = BmpFile(path, width, height)
+    bmp.pixels[:] = canvas
+    bmp.close()
+
+
+def save_buffer(buffer, path):
+    """把已经按BMP布局排好的文件内容（例如共享内存画布）原样写入文件"""
+    with open(path, 'wb') as fp:
+        fp.write(buffer)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 图元栅格化结果的LRU缓存：以(图元类型, 算法, 规范化的控制点)为键，平移后的图元可以复用同一份结果
+from collections import OrderedDict
+import cg_algorithms as alg
+
+# 默认的内存预算（字节）
+DEFAULT_BUDGET = 64 << 20
+# 一个[y, x_start, x_end]区段列表大约占用的字节数
+SPAN_BYTES = 150
+
+
+def canonical(item_type, p_list, algorithm):
+    """把图元参数平移到规范位置，得到缓存键
+
+    只有结果严格随控制点整体平移的算法才做规范化：Bresenham只用整数差分，扫描线填充用精确的整数取整；
+    椭圆在中心坐标的两倍不小于像素到中心的距离的两倍时，各象限的取整都是向下取整。
+    DDA、Naive和曲线的浮点取整依赖绝对坐标，键中保留原始坐标
+
+    :param p_list: (list of list of int) 图元参数
+    :return: (tuple: (key, dx, dy)) 缓存键，以及从规范位置到实际位置的平移量
+    """
+    dx = dy = 0
+    if not p_list:
+        pass
+    elif item_type in ('line', 'polygon') and algorithm in ('Bresenham', 'Scanline'):
+        dx = min(p[0] for p in p_list)
+        dy = min(p[1] for p in p_list)
+    elif item_type == 'ellipse':
+        (x0, y0), (x1, y1) = p_list
+        cx2, cy2, rx, ry = alg.ellipse_extent(p_list)
+        if x0 + x1 >= 2 * rx and y0 + y1 >= 2 * ry:
+            # 规范位置上包围框的左上角在(rx, ry)，同样满足上述条件
+            dx = min(x0, x1) - rx
+            dy = min(y0, y1) - ry
+    key = (item_type, algorithm, tuple((x - dx, y - dy) for x, y in p_list))
+    return key, dx, dy
+
+
+class RasterCache:
+    """
+    按字节预算淘汰最久未使用结果的缓存
+    """
+    def __init__(self, budget=DEFAULT_BUDGET):
+        """
+        :param budget: (int) 缓存结果占用内存的上限（字节），为0时不缓存
+        """
+        self.budget = budget
+        self.entries = OrderedDict()    # 键 -> (结果, 字节数)，最近使用的在末尾
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """:return: 缓存的结果，没有时为None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, nbytes):
+        """
+        :param nbytes: (int) 结果占用的字节数，超过预算的结果不缓存
+        """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if nbytes > self.budget:
+            return
+        self.entries[key] = (value, nbytes)
+        self.size += nbytes
+        while self.size > self.budget:
+            self.size -= self.entries.popitem(last=False)[1][1]
+
+    def __contains__(self, key):
+        """只查询是否缓存，不影响淘汰顺序和命中统计"""
+        return key in self.entries
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """:return: (dict) 命中次数、未命中次数、条目数和占用的字节数"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size}
+
+
+# GUI共用的区段缓存
+span_cache = RasterCache()
+
+
+def render_spans(key):
+    """不经过缓存地绘制规范位置上的图元，可以在后台线程中调用
+
+    :param key: (tuple) canonical返回的缓存键
+    :return: (list of list of int: [[y, x_start, x_end], ...]) 水平区段列表
+    """
+    item_type, algorithm, p_list = key
+    points = [[x, y] for x, y in p_list]
+    if not points:
+        # 被整体裁掉的图元
+        return []
+    elif item_type == 'line':
+        return alg.draw_line(points, algorithm, spans=True)
+    elif item_type == 'polygon':
+        return alg.draw_polygon(points, algorithm, spans=True)
+    elif item_type == 'ellipse':
+        return alg.draw_ellipse(points, spans=True)
+    elif item_type == 'curve' and len(points) >= 2:
+        return alg.draw_curve(points, algorithm, spans=True)
+    return []
+
+
+def draw_spans(item_type, p_list, algorithm, cache=span_cache):
+    """带缓存地绘制图元，结果与alg.draw_line、draw_polygon、draw_ellipse、draw_curve的spans=True模式一致
+
+    :param item_type: (string) 'line'、'polygon'、'ellipse'或'curve'
+    :param cache: (RasterCache) 缓存，缓存的是规范位置上的区段
+    :return: (list of list of int: [[y, x_start, x_end], ...]) 水平区段列表
+    """
+    key, dx, dy = canonical(item_type, p_list, algorithm)
+    spans = cache.get(key)
+    if spans is None:
+        spans = render_spans(key)
+        cache.put(key, spans, SPAN_BYTES * len(spans))
+    if dx == 0 and dy == 0:
+        return spans
+    return [[y + dy, x_start + dx, x_end + dx] for y, x_start, x_end in spans]
@@ -1,111 +1,885 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
-import sys
 import os
+import pickle
+import argparse
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import cg_algorithms as alg
+import cg_parser as cmd
+import cg_bmp
+import cg_cache
+import cg_profile
+import cg_scene
 import numpy as np
-from PIL import Image
+
+
+def item_points(scene, row):
+    """把图元上累积的仿射变换矩阵一次性作用到全部控制点上，结果截断为整数
+
+    :param scene: (cg_scene.Scene) 场景
+    :param row: (int) 图元的序号
+    :return: (list of list of int: [[x_0, y_0], [x_1, y_1], [x_2, y_2], ...]) 变换后的图元参数
+    """
+    return scene.points(row)
+
+
+# 区段的平均长度不小于该值时按行切片写画布，否则用一次花式索引写画布（实测两者在32像素左右持平）
+SPAN_MIN_RUN = 32
+
+
+class Pixels:
+    """
+    逐像素的栅格化结果，用花式索引读写画布；构造时去掉画布以外的像素
+    """
+    def __init__(self, ys, xs, shape):
+        ys = np.asarray(ys, np.int32)
+        xs = np.asarray(xs, np.int32)
+        inside = (ys >= 0) & (ys < shape[0]) & (xs >= 0) & (xs < shape[1])
+        self.ys = ys[inside]
+        self.xs = xs[inside]
+
+    @classmethod
+    def from_spans(cls, spans, shape):
+        return cls(*span_pixels(spans), shape)
+
+    def __len__(self):
+        return len(self.ys)
+
+    def mark(self, mask):
+        mask[self.ys, self.xs] = True
+
+    def fill(self, canvas, color):
+        canvas[self.ys, self.xs] = color
+
+    def bounds(self):
+        """:return: (tuple of int: (top, left, bottom, right)) 包围盒，bottom和right不包含在内；没有像素时为(0, 0, 0, 0)"""
+        if not len(self.ys):
+            return 0, 0, 0, 0
+        return int(self.ys.min()), int(self.xs.min()), int(self.ys.max()) + 1, int(self.xs.max()) + 1
+
+    def crop(self, top, left, bottom, right):
+        """:return: (Pixels) 落在[top, bottom) × [left, right)内的像素"""
+        inside = (self.ys >= top) & (self.ys < bottom) & (self.xs >= left) & (self.xs < right)
+        cropped = Pixels.__new__(Pixels)
+        cropped.ys = self.ys[inside]
+        cropped.xs = self.xs[inside]
+        return cropped
+
+
+class Spans:
+    """
+    由水平区段组成的栅格化结果，每个区段用一次行切片读写画布；构造时把区段截断到画布以内
+    """
+    def __init__(self, spans, shape):
+        spans = np.asarray(spans, np.int32).reshape(-1, 3)
+        height, width = shape[:2]
+        ys = spans[:, 0]
+        x_start = np.maximum(spans[:, 1], 0)
+        x_stop = np.minimum(spans[:, 2], width - 1) + 1
+        inside = (ys >= 0) & (ys < height) & (x_start < x_stop)
+        # [(y, x_start, x_stop), ...]，x_stop不包含在内
+        self.rows = list(zip(ys[inside].tolist(), x_start[inside].tolist(), x_stop[inside].tolist()))
+
+    def __len__(self):
+        return sum(x_stop - x_start for y, x_start, x_stop in self.rows)
+
+    def mark(self, mask):
+        for y, x_start, x_stop in self.rows:
+            mask[y, x_start:x_stop] = True
+
+    def masked(self, mask):
+        """:return: (tuple of numpy.ndarray: (ys, xs)) 落在mask内的像素"""
+        ys = []
+        xs = []
+        for y, x_start, x_stop in self.rows:
+            hit = np.flatnonzero(mask[y, x_start:x_stop])
+            if len(hit):
+                ys.append(np.full(len(hit), y, np.int32))
+                xs.append((hit + x_start).astype(np.int32))
+        if not ys:
+            return np.zeros(0, np.int32), np.zeros(0, np.int32)
+        return np.concatenate(ys), np.concatenate(xs)
+
+    def fill(self, canvas, color):
+        for y, x_start, x_stop in self.rows:
+            canvas[y, x_start:x_stop] = color
+
+    def bounds(self):
+        """:return: (tuple of int: (top, left, bottom, right)) 包围盒，bottom和right不包含在内；没有区段时为(0, 0, 0, 0)"""
+        if not self.rows:
+            return 0, 0, 0, 0
+        ys, x_starts, x_stops = zip(*self.rows)
+        return min(ys), min(x_starts), max(ys) + 1, max(x_stops)
+
+    def crop(self, top, left, bottom, right):
+        """:return: (Spans) 截断到[top, bottom) × [left, right)以内的区段"""
+        cropped = Spans.__new__(Spans)
+        cropped.rows = [(y, max(x_start, left), min(x_stop, right)) for y, x_start, x_stop in self.rows
+                        if top <= y < bottom and x_start < right and x_stop > left]
+        return cropped
+
+
+def span_pixels(spans):
+    """把水平区段展开为像素
+
+    :return: (tuple of numpy.ndarray: (ys, xs)) 像素的y坐标和x坐标
+    """
+    spans = np.asarray(spans, np.int32).reshape(-1, 3)
+    lengths = spans[:, 2] - spans[:, 1] + 1
+    ys = np.repeat(spans[:, 0], lengths)
+    # 每个像素的x坐标 = 所在区段的x_start + 它在区段内的序号
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    xs = np.repeat(spans[:, 1], lengths) + offsets
+    return ys, xs
+
+
+def pixel_runs(ys, xs):
+    """把像素按行排序后，把同一行上连续的像素合并为水平区段
+
+    :return: (numpy.ndarray: [[y, x_start, x_end], ...]) 水平区段，x_end包含在内
+    """
+    order = np.lexsort((xs, ys))
+    ys = ys[order]
+    xs = xs[order]
+    new_run = np.ones(len(xs), bool)
+    new_run[1:] = (ys[1:] != ys[:-1]) | (xs[1:] - xs[:-1] > 1)
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], len(xs)) - 1
+    return np.stack([ys[starts], xs[starts], xs[ends]], 1)
+
+
+def item_pixels(item_type, p_list, algorithm):
+    """:return: (tuple of list of int: (xs, ys)) 图元像素点的x坐标列表和y坐标列表"""
+    if item_type == 'line':
+        return alg.draw_lines([p_list] if p_list else [], algorithm)
+    if item_type == 'polygon':
+        return alg.draw_lines(alg.polygon_edges(p_list), algorithm)
+    if item_type == 'ellipse':
+        return alg.draw_ellipses([p_list])
+    if item_type == 'curve':
+        pixels = alg.draw_curve(p_list, algorithm)
+        return [p[0] for p in pixels], [p[1] for p in pixels]
+    return [], []
+
+
+def item_geometry(item_type, p_list, algorithm):
+    """栅格化单个图元，不截断到画布
+
+    :return: (tuple) 区段平均长度不小于SPAN_MIN_RUN时为('spans', [[y, x_start, x_end], ...])，
+        否则为('pixels', ys, xs)，坐标都是numpy.ndarray
+    """
+    if item_type == 'polygon' and algorithm == 'Scanline':
+        spans = np.asarray(alg.fill_polygon(p_list), np.int32).reshape(-1, 3)
+        if (spans[:, 2] - spans[:, 1] + 1).sum() >= SPAN_MIN_RUN * len(spans):
+            return 'spans', spans
+        return ('pixels',) + span_pixels(spans)
+    xs, ys = item_pixels(item_type, p_list, algorithm)
+    ys = np.asarray(ys, np.int32)
+    xs = np.asarray(xs, np.int32)
+    # 连通的图元在它跨越的每一行上至少有一个区段，行数太多时不必排序就知道区段平均长度不够
+    if len(xs) >= SPAN_MIN_RUN * (ys.max(initial=0) - ys.min(initial=0) + 1):
+        spans = pixel_runs(ys, xs)
+        if (spans[:, 2] - spans[:, 1] + 1).sum() >= SPAN_MIN_RUN * len(spans):
+            return 'spans', spans
+    return 'pixels', ys, xs
+
+
+# 栅格化结果的缓存，形状相同、只差平移的图元共用一份结果
+raster_cache = cg_cache.RasterCache()
+
+
+def rasterize_item(item_type, p_list, algorithm, shape):
+    """栅格化单个图元，超出画布的部分被截掉；结果经过raster_cache缓存
+
+    :param shape: (tuple of int) 画布的形状
+    :return: (Pixels or Spans) 栅格化结果，区段平均长度不小于SPAN_MIN_RUN时为Spans，否则为Pixels
+    """
+    key, dx, dy = cg_cache.canonical(item_type, p_list, algorithm)
+    geometry = raster_cache.get(key)
+    if geometry is None:
+        geometry = item_geometry(item_type, [[x, y] for x, y in key[2]], algorithm)
+        raster_cache.put(key, geometry, sum(a.nbytes for a in geometry[1:]))
+    if geometry[0] == 'spans':
+        spans = geometry[1]
+        if dx or dy:
+            spans = spans + np.array([dy, dx, dx], np.int32)
+        return Spans(spans, shape)
+    return Pixels(geometry[1] + dy, geometry[2] + dx, shape)
+
+
+# render按该边长的图块判断图元是否与重新合成的区域相交
+REGION_TILE = 16
+
+
+class Compositor:
+    """
+    增量画布合成器：保存持久的画布和每个图元的像素缓存，只重新栅格化被修改过的图元，
+    只重新合成被修改图元新旧像素覆盖的区域，并且只重画包围盒与该区域相交的图元
+    """
+    def __init__(self):
+        self.canvas = np.zeros([0, 0, 3], np.uint8)
+        self.pixel_cache = {}   # 图元ID -> Pixels或Spans
+        self.bounds = np.zeros((0, 4), np.int64)    # row -> 缓存像素的包围盒[top, left, bottom, right]
+        self.dirty = set()      # 自上次合成以来被修改过的图元ID
+        self.affected = None    # 最近一次render重新合成的区域，没有重新合成时为None
+
+    def reset(self, width, height):
+        self.canvas = np.zeros([height, width, 3], np.uint8)
+        self.canvas.fill(255)
+        self.pixel_cache = {}
+        self.bounds = np.zeros((0, 4), np.int64)
+        self.dirty = set()
+        self.affected = None
+
+    def attach(self, canvas):
+        """改为在给定的画布（例如内存映射的BMP文件的像素区）上继续合成，canvas的内容须与当前画布一致"""
+        self.canvas = canvas
+
+    def invalidate(self, item_id):
+        self.dirty.add(item_id)
+
+    def rasterize(self, item_id, scene):
+        """:return: (Pixels or Spans) 图元在当前画布上的栅格化结果"""
+        row = scene.row(item_id)
+        return rasterize_item(scene.item_type(row), item_points(scene, row), scene.algorithm(row), self.canvas.shape)
+
+    def render(self, scene):
+        """把场景合成到画布上，覆盖顺序与图元的序号一致
+
+        :param scene: (cg_scene.Scene) 全部图元
+        :return: (numpy.ndarray) 合成后的画布，下次render时会被原地修改
+        """
+        if not self.dirty:
+            self.affected = None
+            return self.canvas
+        n = len(scene)
+        self.bounds = cg_scene.grow(self.bounds, n)
+        affected = self.affected = np.zeros(self.canvas.shape[:2], bool)
+        for item_id in self.dirty:
+            old = self.pixel_cache.pop(item_id, None)
+            if old is not None:
+                old.mark(affected)
+            row = scene.row(item_id)
+            if row is not None:
+                raster = self.rasterize(item_id, scene)
+                self.pixel_cache[item_id] = raster
+                self.bounds[row] = raster.bounds()
+                raster.mark(affected)
+        self.dirty = set()
+
+        ys = np.flatnonzero(affected.any(1))
+        if not len(ys):
+            return self.canvas
+        xs = np.flatnonzero(affected.any(0))
+        top, bottom, left, right = ys[0], ys[-1] + 1, xs[0], xs[-1] + 1
+        window = affected[top:bottom, left:right]
+        self.canvas[top:bottom, left:right][window] = 255
+        self.paint_rows(scene, self.overlapping(window, top, left, n), affected)
+        return self.canvas
+
+    def overlapping(self, window, top, left, n):
+        """找出包围盒与重新合成的区域相交的图元
+
+        :param window: (numpy.ndarray of bool) 重新合成的区域的包围盒内的affected
+        :param top: (int) window在画布上的上边界
+        :param left: (int) window在画布上的左边界
+        :param n: (int) 图元数
+        :return: (numpy.ndarray of int) 按序号排列的图元序号
+        """
+        size = REGION_TILE
+        height, width = window.shape
+        tiles = np.logical_or.reduceat(window, np.arange(0, height, size), axis=0)
+        tiles = np.logical_or.reduceat(tiles, np.arange(0, width, size), axis=1)
+        # 二维前缀和：summed[i, j]是tiles[:i, :j]中被影响的图块数
+        summed = np.zeros((tiles.shape[0] + 1, tiles.shape[1] + 1), np.int64)
+        summed[1:, 1:] = tiles.cumsum(0).cumsum(1)
+        # 把每个图元的包围盒截断到window以内，再换算为图块下标，空的包围盒截断后不覆盖任何图块
+        bounds = self.bounds[:n]
+        tile_top = np.clip(bounds[:, 0] - top, 0, height) // size
+        tile_left = np.clip(bounds[:, 1] - left, 0, width) // size
+        tile_bottom = (np.clip(bounds[:, 2] - top, 0, height) + size - 1) // size
+        tile_right = (np.clip(bounds[:, 3] - left, 0, width) + size - 1) // size
+        hit = (summed[tile_bottom, tile_right] - summed[tile_top, tile_right]
+               - summed[tile_bottom, tile_left] + summed[tile_top, tile_left])
+        return np.flatnonzero(hit > 0)
+
+    def paint_rows(self, scene, rows, mask):
+        """按序号把给定的图元中落在mask内的像素画到画布上
+
+        全部像素按图元的序号收集到一起后只做一次花式索引赋值，被多个图元覆盖的像素取序号最大的图元的颜色
+        """
+        ids = scene.ids
+        ys = []
+        xs = []
+        for row in rows.tolist():
+            raster = self.pixel_cache[ids[row]]
+            if isinstance(raster, Pixels):
+                ys.append(raster.ys)
+                xs.append(raster.xs)
+            else:
+                span_ys, span_xs = raster.masked(mask)
+                ys.append(span_ys)
+                xs.append(span_xs)
+        if not ys:
+            return
+        # 每个像素所属图元的序号，按序号递增
+        labels = np.repeat(rows, [len(part) for part in ys])
+        ys = np.concatenate(ys)
+        xs = np.concatenate(xs)
+        hit = mask[ys, xs]
+        ys = ys[hit]
+        xs = xs[hit]
+        labels = labels[hit]
+        # 稳定排序后同一像素的各个图元仍按序号排列，每个像素只保留最后一个，即序号最大的图元
+        pixels = ys.astype(np.int64) * mask.shape[1] + xs
+        order = np.argsort(pixels, kind='stable')
+        pixels = pixels[order]
+        last = np.ones(len(pixels), bool)
+        last[:-1] = pixels[1:] != pixels[:-1]
+        order = order[last]
+        self.canvas[ys[order], xs[order]] = scene.colors[labels[order]]
+
+
+def render_snapshot(canvas, snapshot):
+    """在一个新的合成器上把一份场景快照完整合成到空白画布上
+
+    :param canvas: (numpy.ndarray) 已填成白色的画布
+    :param snapshot: (bytes) pickle序列化的cg_scene.Scene
+    """
+    scene = pickle.loads(snapshot)
+    compositor = Compositor()
+    compositor.attach(canvas)
+    compositor.dirty = set(scene.ids)
+    compositor.render(scene)
+
+
+def save_snapshot(path, width, height, snapshot):
+    """进程池中执行的任务：把场景快照直接合成到内存映射的BMP文件中"""
+    if not cg_bmp.is_bmp(path) or width == 0 or height == 0:
+        canvas = np.full([height, width, 3], 255, np.uint8)
+        render_snapshot(canvas, snapshot)
+        cg_bmp.save_image(canvas, path)
+        return
+    bmp = cg_bmp.BmpFile(path, width, height)
+    bmp.pixels.fill(255)
+    render_snapshot(bmp.pixels, snapshot)
+    bmp.close()
+
+
+# 分块合成时图块的边长
+TILE_SIZE = 128
+
+
+def scene_bounds(scene, points, starts):
+    """一次性估计全部图元像素的包围盒，四周留1像素余量
+
+    :param scene: (cg_scene.Scene) 场景
+    :param points, starts: cg_scene.Scene.all_points的结果
+    :return: (tuple: (rows, bounds)) 有控制点的图元的序号，以及它们的包围盒[[x_min, y_min, x_max, y_max], ...]
+    """
+    rows = np.flatnonzero(np.diff(starts))
+    first = starts[rows]
+    # 线段、多边形和曲线都落在控制点的凸包内；相邻的非空图元之间只隔着没有控制点的图元，可以按起始位置分段归约
+    bounds = np.empty((len(rows), 4), np.int64)
+    bounds[:, :2] = np.minimum.reduceat(points, first) - 1 if len(rows) else 0
+    bounds[:, 2:] = np.maximum.reduceat(points, first) + 1 if len(rows) else 0
+    # 椭圆的像素可能超出包围框，按alg.ellipse_extent计算
+    ellipses = scene.types[rows] == cg_scene.ITEM_TYPE_CODES['ellipse']
+    (x0, y0), (x1, y1) = points[first[ellipses]].T, points[first[ellipses] + 1].T
+    a = np.abs(x1 - x0)
+    b = np.abs(y1 - y0)
+    cx = np.abs(x0 + x1) // 2
+    cy = np.abs(y0 + y1) // 2
+    rx = a * (b + 1) // (2 * np.maximum(b, 1)) + 2
+    ry = b // 2 + 2
+    bounds[ellipses] = np.stack([cx - rx, cy - ry, cx + rx, cy + ry], axis=1)
+    return rows, bounds
+
+
+def bin_items(scene, shape, tile_size=TILE_SIZE):
+    """按包围盒把图元分到与之相交的图块中，每个图块内保持图元的顺序
+
+    :return: (list of tuple: [((top, left, bottom, right), [(index, item_type, p_list, algorithm, color), ...]), ...])
+        非空的图块及其图元，index是图元的序号
+    """
+    height, width = shape[:2]
+    rows = (height + tile_size - 1) // tile_size
+    cols = (width + tile_size - 1) // tile_size
+    tiles = [[] for _ in range(rows * cols)]
+    # 整个场景的变换和包围盒都是向量化计算的
+    points, starts = scene.all_points()
+    indices, bounds = scene_bounds(scene, points, starts)
+    visible = ((bounds[:, 2] >= 0) & (bounds[:, 3] >= 0) & (bounds[:, 0] < width) & (bounds[:, 1] < height))
+    for index, (x_min, y_min, x_max, y_max) in zip(indices[visible].tolist(), bounds[visible].tolist()):
+        p_list = points[starts[index]:starts[index + 1]].tolist()
+        task = (index, scene.item_type(index), p_list, scene.algorithm(index), tuple(scene.colors[index].tolist()))
+        for row in range(max(y_min, 0) // tile_size, min(y_max, height - 1) // tile_size + 1):
+            for col in range(max(x_min, 0) // tile_size, min(x_max, width - 1) // tile_size + 1):
+                tiles[row * cols + col].append(task)
+    result = []
+    for index, items in enumerate(tiles):
+        if items:
+            top = index // cols * tile_size
+            left = index % cols * tile_size
+            result.append(((top, left, min(top + tile_size, height), min(left + tile_size, width)), items))
+    return result
+
+
+# 工作进程中已打开的共享内存：名字 -> (SharedMemory, numpy.ndarray)
+attached_canvases = {}
+# 工作进程中本次合成已栅格化的图元：[合成编号, {图元序号: Pixels或Spans}]，跨多个图块的图元在同一进程中只栅格化一次
+tile_rasters = [None, {}]
+
+
+def render_tile(name, shape, generation, tile, items):
+    """进程池中执行的任务：按顺序把图元在图块内的部分直接画到共享内存画布上，后画的覆盖先画的
+
+    :param name: (string) 共享内存的名字
+    :param shape: (tuple of int) 画布的形状
+    :param generation: (int) 合成编号，编号变化时丢弃上一次合成的栅格化结果
+    :param tile: (tuple of int: (top, left, bottom, right)) 图块范围，不含bottom和right
+    :param items: (list of tuple: [(index, item_type, p_list, algorithm, color), ...]) 与图块相交的图元
+    """
+    if name not in attached_canvases:
+        shm = shared_memory.SharedMemory(name=name)
+        attached_canvases[name] = (shm, cg_bmp.pixel_view(shm.buf, shape[1], shape[0]))
+    canvas = attached_canvases[name][1]
+    if tile_rasters[0] != (name, generation):
+        tile_rasters[0] = (name, generation)
+        tile_rasters[1] = {}
+    rasters = tile_rasters[1]
+    for index, item_type, p_list, algorithm, color in items:
+        raster = rasters.get(index)
+        if raster is None:
+            raster = rasters[index] = rasterize_item(item_type, p_list, algorithm, shape)
+        raster.crop(*tile).fill(canvas, color)
+
+
+class TiledRenderer:
+    """
+    分块合成器：把画布分成图块，由进程池中的进程各自合成若干图块，写入同一块共享内存画布；
+    共享内存按BMP文件布局存放，保存时原样写出
+    """
+    def __init__(self, pool, jobs, tile_size=TILE_SIZE):
+        self.pool = pool
+        self.jobs = jobs
+        self.tile_size = tile_size
+        self.shm = None
+        self.canvas = None
+        self.size = 0           # 共享内存中BMP文件内容的字节数
+        self.generation = 0
+
+    def render(self, scene, shape):
+        """
+        :param scene: (cg_scene.Scene) 全部图元
+        :param shape: (tuple of int) 画布的形状
+        :return: (numpy.ndarray) 共享内存上的画布，下次render时会被覆盖
+        """
+        shape = tuple(shape)
+        if self.canvas is None or self.canvas.shape != shape:
+            self.close()
+            height, width = shape[:2]
+            self.size = cg_bmp.HEADER_SIZE + cg_bmp.row_stride(width) * height
+            self.shm = shared_memory.SharedMemory(create=True, size=self.size)
+            self.shm.buf[:cg_bmp.HEADER_SIZE] = cg_bmp.bmp_header(width, height)
+            self.canvas = cg_bmp.pixel_view(self.shm.buf, width, height)
+        self.canvas.fill(255)
+        self.generation += 1
+        tasks = bin_items(scene, shape, self.tile_size)
+        tiles = [tile for tile, items in tasks]
+        items = [items for tile, items in tasks]
+        # 相邻的图块成批交给同一个进程，跨图块的图元可以复用栅格化结果
+        chunksize = max(len(tasks) // (4 * self.jobs), 1)
+        # 等待全部图块完成，并让子进程中的异常在这里抛出
+        list(self.pool.map(render_tile, repeat(self.shm.name), repeat(shape), repeat(self.generation),
+                           tiles, items, chunksize=chunksize))
+        return self.canvas
+
+    def save(self, path):
+        """保存最近一次合成的画布，.bmp直接写出共享内存中的文件内容"""
+        height, width = self.canvas.shape[:2]
+        if not cg_bmp.is_bmp(path) or width == 0 or height == 0:
+            cg_bmp.save_image(self.canvas, path)
+            return
+        with self.shm.buf[:self.size] as content:
+            cg_bmp.save_buffer(content, path)
+
+    def close(self):
+        if self.shm is not None:
+            self.canvas = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def save_tiles(path, base_name, width, height, tiles):
+    """进程池中执行的任务：以共享内存中的基准画布为底，覆盖上变化过的图块后写出文件
+
+    :param base_name: (string) 按BMP文件布局存放基准画布的共享内存的名字
+    :param tiles: (list of tuple: [((top, left, bottom, right), numpy.ndarray), ...]) 与基准画布不同的图块
+    """
+    base = shared_memory.SharedMemory(name=base_name)
+    try:
+        if cg_bmp.is_bmp(path):
+            bmp = cg_bmp.BmpFile(path, width, height)
+            bmp.mm[:] = base.buf[:bmp.size]
+            canvas = bmp.pixels
+        else:
+            bmp = None
+            canvas = np.array(cg_bmp.pixel_view(base.buf, width, height))
+        for (top, left, bottom, right), pixels in tiles:
+            canvas[top:bottom, left:right] = pixels
+        if bmp is None:
+            cg_bmp.save_image(canvas, path)
+        else:
+            del canvas
+            bmp.close()
+    finally:
+        base.close()
+
+
+class TileSnapshots:
+    """
+    按图块写时复制的画布快照：共享内存中保存一张基准画布，每次saveCanvas只复制自基准画布以来变化过的图块；
+    变化的图块超过一半时，以当前画布作为新的基准
+    """
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.base = None        # 基准画布所在的SharedMemory
+        self.touched = None     # (numpy.ndarray of bool) 自基准画布以来变化过的图块
+        self.retired = []       # 已被替换、仍可能被未完成任务读取的基准画布：[(SharedMemory, 读取它的任务), ...]
+        self.tasks = []         # 读取当前基准画布的任务
+
+    def invalidate(self):
+        """画布被重置，下一次快照时重新建立基准画布"""
+        self.retire()
+
+    def take(self, canvas, affected):
+        """
+        :param canvas: (numpy.ndarray) 当前画布
+        :param affected: (numpy.ndarray of bool or None) 自上次快照以来重新合成过的区域
+        :return: (tuple: (string, list of tuple)) 基准画布的共享内存名字，以及与基准画布不同的图块
+        """
+        height, width = canvas.shape[:2]
+        size = self.tile_size
+        if self.base is not None and affected is not None:
+            # 把像素级的affected归约为图块级
+            rows = np.logical_or.reduceat(affected, np.arange(0, height, size), axis=0)
+            self.touched |= np.logical_or.reduceat(rows, np.arange(0, width, size), axis=1)
+        if self.base is None or 2 * self.touched.sum() > self.touched.size:
+            self.rebase(canvas)
+        tiles = []
+        for row, col in zip(*np.nonzero(self.touched)):
+            top, left = row * size, col * size
+            bottom, right = min(top + size, height), min(left + size, width)
+            tiles.append(((top, left, bottom, right), canvas[top:bottom, left:right].copy()))
+        return self.base.name, tiles
+
+    def track(self, task):
+        """记录读取当前基准画布的任务"""
+        self.tasks.append(task)
+
+    def rebase(self, canvas):
+        self.retire()
+        height, width = canvas.shape[:2]
+        self.base = shared_memory.SharedMemory(
+            create=True, size=cg_bmp.HEADER_SIZE + cg_bmp.row_stride(width) * height)
+        self.base.buf[:cg_bmp.HEADER_SIZE] = cg_bmp.bmp_header(width, height)
+        cg_bmp.pixel_view(self.base.buf, width, height)[:] = canvas
+        size = self.tile_size
+        self.touched = np.zeros([(height + size - 1) // size, (width + size - 1) // size], bool)
+
+    def retire(self):
+        if self.base is not None:
+            self.retired.append((self.base, self.tasks))
+            self.base = None
+            self.tasks = []
+        # 释放已经没有任务读取的基准画布
+        alive = []
+        for shm, tasks in self.retired:
+            if all(task.done() for task in tasks):
+                shm.close()
+                shm.unlink()
+            else:
+                alive.append((shm, tasks))
+        self.retired = alive
+
+    def close(self):
+        """释放全部基准画布，调用前须等待所有任务完成"""
+        self.retire()
+        for shm, tasks in self.retired:
+            shm.close()
+            shm.unlink()
+        self.retired = []
+
+
+# 绘制指令对应的图元类型
+ITEM_TYPES = {
+    cmd.DRAW_LINE: 'line',
+    cmd.DRAW_POLYGON: 'polygon',
+    cmd.DRAW_ELLIPSE: 'ellipse',
+    cmd.DRAW_CURVE: 'curve',
+    cmd.FILL_POLYGON: 'polygon',
+}
+
+
+class Interpreter:
+    """
+    指令解释器，通过操作码分派表执行cg_parser编译出的Command
+    """
+    def __init__(self, output_dir, jobs=1, tile_size=0, snapshots='scene'):
+        """
+        :param output_dir: (string) 输出目录
+        :param jobs: (int) 并行合成saveCanvas的进程数，为1时在当前进程中增量合成
+        :param tile_size: (int) 大于0且jobs > 1时，每次saveCanvas按该边长分块，由jobs个进程并行合成同一张画布
+        :param snapshots: (string) jobs > 1时saveCanvas的快照方式：'scene'把序列化的图元交给子进程完整合成；
+            'tiles'在当前进程中增量合成，只把变化过的图块交给子进程写文件，适合两次保存之间改动很少的指令文件
+        """
+        self.output_dir = output_dir
+        self.jobs = jobs
+        self.tile_size = tile_size
+        self.snapshots = snapshots
+        self.pool = None        # jobs > 1时的进程池
+        self.tiler = None       # 分块合成时的TiledRenderer
+        self.tile_snapshots = None  # 按图块写时复制快照时的TileSnapshots
+        self.pending = []       # 尚未完成的保存任务
+        self.pending_paths = {}  # 输出路径 -> 最近一个写该路径的保存任务
+        self.bmp = None         # 串行合成时合成器正在其上绘制的BMP文件
+        self.scene = cg_scene.Scene()
+        self.compositor = Compositor()
+        self.pen_color = np.zeros(3, np.uint8)
+        self.dispatch = {
+            cmd.RESET_CANVAS: self.reset_canvas,
+            cmd.SAVE_CANVAS: self.save_canvas,
+            cmd.SET_COLOR: self.set_color,
+            cmd.DRAW_LINE: self.draw,
+            cmd.DRAW_POLYGON: self.draw,
+            cmd.DRAW_ELLIPSE: self.draw,
+            cmd.DRAW_CURVE: self.draw,
+            cmd.FILL_POLYGON: self.draw,
+            cmd.TRANSLATE: self.transform,
+            cmd.ROTATE: self.transform,
+            cmd.SCALE: self.transform,
+            cmd.CLIP: self.clip,
+        }
+
+    def run(self, commands):
+        """依次执行指令
+
+        :param commands: (iterable of cg_parser.Command) 指令序列，可以是cg_parser.parse_file的生成器或compile_file的结果
+        """
+        dispatch = self.dispatch
+        if self.jobs <= 1:
+            try:
+                for command in commands:
+                    dispatch[command.op](command)
+            finally:
+                self.release_bmp()
+            return
+        with ProcessPoolExecutor(self.jobs) as self.pool:
+            if self.tile_size > 0:
+                self.tiler = TiledRenderer(self.pool, self.jobs, self.tile_size)
+            elif self.snapshots == 'tiles':
+                self.tile_snapshots = TileSnapshots()
+            try:
+                for command in commands:
+                    dispatch[command.op](command)
+                # 取出结果，让子进程中的异常在这里抛出
+                for future in self.pending:
+                    future.result()
+            finally:
+                if self.tiler is not None:
+                    self.tiler.close()
+                if self.tile_snapshots is not None:
+                    # 确保没有任务还在读取基准画布
+                    for future in self.pending:
+                        future.exception()
+                    self.tile_snapshots.close()
+                self.pool = None
+                self.tiler = None
+                self.tile_snapshots = None
+                self.pending = []
+                self.pending_paths = {}
+
+    def reset_canvas(self, command):
+        width, height = command.ints
+        self.scene = cg_scene.Scene()
+        self.compositor.reset(width, height)
+        self.release_bmp()
+        if self.tile_snapshots is not None:
+            self.tile_snapshots.invalidate()
+
+    def release_bmp(self):
+        """关闭上一次保存的BMP文件，合成器若仍在其上绘制则先把画布复制回内存"""
+        if self.bmp is None:
+            return
+        if self.compositor.canvas is self.bmp.pixels:
+            self.compositor.attach(np.array(self.bmp.pixels))
+        self.bmp.close()
+        self.bmp = None
+
+    def save_canvas(self, command):
+        path = os.path.join(self.output_dir, command.text + '.bmp')
+        if self.pool is None:
+            self.save_incremental(path)
+            return
+        if self.tiler is not None:
+            self.tiler.render(self.scene, self.compositor.canvas.shape)
+            self.tiler.save(path)
+            return
+        height, width = self.compositor.canvas.shape[:2]
+        # 限制排队中的任务数，避免快照占用过多内存
+        if len(self.pending) >= 2 * self.jobs:
+            self.pending.pop(0).result()
+        # 同名的保存须按顺序完成，否则先提交的任务可能最后写完，覆盖后面的结果
+        previous = self.pending_paths.get(path)
+        if previous is not None:
+            previous.result()
+        if self.tile_snapshots is not None and width > 0 and height > 0:
+            canvas = self.compositor.render(self.scene)
+            base_name, tiles = self.tile_snapshots.take(canvas, self.compositor.affected)
+            task = self.pool.submit(save_tiles, path, base_name, width, height, tiles)
+            self.tile_snapshots.track(task)
+        else:
+            # 序列化即是快照：之后对场景的修改不会影响已提交的任务
+            snapshot = pickle.dumps(self.scene, pickle.HIGHEST_PROTOCOL)
+            task = self.pool.submit(save_snapshot, path, width, height, snapshot)
+        self.pending.append(task)
+        self.pending_paths[path] = task
+
+    def save_incremental(self, path):
+        """在当前进程中增量合成：新文件复制上一个文件的内容后，合成器直接在新文件的像素区上更新；
+        与上一个文件同名时直接在上一个文件上更新"""
+        height, width = self.compositor.canvas.shape[:2]
+        if not cg_bmp.is_bmp(path) or width == 0 or height == 0:
+            cg_bmp.save_image(self.compositor.render(self.scene), path)
+            return
+        if self.bmp is not None and os.path.abspath(self.bmp.path) == os.path.abspath(path):
+            self.compositor.render(self.scene)
+            return
+        bmp = cg_bmp.BmpFile(path, width, height)
+        if self.bmp is None:
+            bmp.pixels[:] = self.compositor.canvas
+        else:
+            bmp.copy_from(self.bmp)
+        self.compositor.attach(bmp.pixels)
+        self.release_bmp()
+        self.bmp = bmp
+        self.compositor.render(self.scene)
+        # publish要关闭并重新映射文件：合成器先放开旧的视图，之后在新的映射上继续合成
+        self.compositor.attach(None)
+        bmp.publish()
+        self.compositor.attach(bmp.pixels)
+
+    def set_color(self, command):
+        self.pen_color[:] = command.ints
+
+    def draw(self, command):
+        item_id = command.item_id
+        self.scene.add(item_id, ITEM_TYPES[command.op], cmd.points(command.ints), command.text, self.pen_color)
+        self.compositor.invalidate(item_id)
+
+    def transform(self, command):
+        row = self.scene.row(command.item_id)
+        if row is None:
+            return
+        if command.op == cmd.TRANSLATE:
+            dx, dy = command.ints
+            matrix = alg.translate_matrix(dx, dy)
+        elif command.op == cmd.ROTATE:
+            x, y, r = command.ints
+            matrix = alg.rotate_matrix(x, y, r)
+        else:
+            x, y = command.ints
+            matrix = alg.scale_matrix(x, y, command.value)
+        self.scene.set_matrix(row, alg.compose_matrix(matrix, self.scene.matrix(row)))
+        self.compositor.invalidate(command.item_id)
+
+    def clip(self, command):
+        row = self.scene.row(command.item_id)
+        # 只裁剪线段和多边形，椭圆和曲线的控制点不能直接裁剪
+        if row is None or self.scene.item_type(row) not in ('line', 'polygon'):
+            return
+        x0, y0, x1, y1 = command.ints
+        p_list = item_points(self.scene, row)
+        if self.scene.item_type(row) == 'line':
+            if p_list:
+                kept, rejected = alg.clip_lines([p_list], x0, y0, x1, y1, command.text)
+                # 整条被裁掉的线段由rejected标记，不再保留[[0, 0], [0, 0]]这样的占位结果
+                p_list = [] if rejected[0] else kept[0]
+        else:
+            p_list = alg.clip_polygon(p_list, x0, y0, x1, y1)
+        # set_points同时把变换矩阵重置为单位矩阵
+        self.scene.set_points(row, p_list)
+        self.compositor.invalidate(command.item_id)
+
+
+def enable_profiling(interpreter, profiler):
+    """给解释器接入剖析器：按指令计时，并把变换、栅格化、合成和保存分别计为一个阶段
+
+    只包装当前进程中执行的函数，--jobs模式下子进程中的合成不计入
+
+    :param interpreter: (Interpreter) 解释器
+    :param profiler: (cg_profile.Profiler) 剖析器
+    :return: (callable) 撤销全部包装的函数
+    """
+    global item_points
+    original_points = item_points
+    item_points = profiler.stage('transform', item_points)
+    profiler.start()
+    compositor = interpreter.compositor
+    compositor.rasterize = profiler.rasterize(compositor.rasterize)
+    compositor.render = profiler.stage('composite', compositor.render)
+    dispatch = dict(interpreter.dispatch)
+    # 保存指令中扣除合成之后的时间即是编码和写文件的时间
+    interpreter.dispatch[cmd.SAVE_CANVAS] = profiler.stage('encode', interpreter.dispatch[cmd.SAVE_CANVAS])
+    for op, function in interpreter.dispatch.items():
+        interpreter.dispatch[op] = profiler.command(op, function)
+
+    def disable():
+        global item_points
+        item_points = original_points
+        profiler.stop()
+        del compositor.rasterize
+        del compositor.render
+        interpreter.dispatch = dispatch
+    return disable
+
 
 if __name__ == '__main__':
-    input_file = sys.argv[1]
-    output_dir = sys.argv[2]
-    os.makedirs(output_dir, exist_ok=True)
-
-    item_dict = {}
-    pen_color = np.zeros(3, np.uint8)
-    width = 0
-    height = 0
-
-    with open(input_file, 'r') as fp:
-        line = fp.readline()
-        while line:
-            line = line.strip().split(' ')
-            if line[0] == 'resetCanvas':
-                width = int(line[1])
-                height = int(line[2])
-                item_dict = {}
-            elif line[0] == 'saveCanvas':
-                save_name = line[1]
-                canvas = np.zeros([height, width, 3], np.uint8)
-                canvas.fill(255)
-                for item_type, p_list, algorithm, color in item_dict.values():
-                    if item_type == 'line':
-                        pixels = alg.draw_line(p_list, algorithm)
-                        for x, y in pixels:
-                            canvas[y, x] = color
-                    elif item_type == 'polygon':
-                        pixels = alg.draw_polygon(p_list, algorithm)
-                        for x, y in pixels:
-                            canvas[y, x] = color
-                    elif item_type == 'ellipse':
-                        pixels = alg.draw_ellipse(p_list)
-                        for x, y in pixels:
-                            canvas[y, x] = color
-                    elif item_type == 'curve':
-                        pixels = alg.draw_curve(p_list, algorithm)
-                        for x, y in pixels:
-                            canvas[y, x] = color
-                Image.fromarray(canvas).save(os.path.join(output_dir, save_name + '.bmp'), 'bmp')
-            elif line[0] == 'setColor':
-                pen_color[0] = int(line[1])
-                pen_color[1] = int(line[2])
-                pen_color[2] = int(line[3])
-            elif line[0] == 'drawLine':
-                item_id = line[1]
-                x0 = int(line[2])
-                y0 = int(line[3])
-                x1 = int(line[4])
-                y1 = int(line[5])
-                algorithm = line[6]
-                item_dict[item_id] = ['line', [[x0, y0], [x1, y1]], algorithm, np.array(pen_color)]
-            elif line[0] == 'drawPolygon':
-                item_id = line[1]
-                p_list = []
-                for i in range(2, len(line) - 1, 2):
-                    p_list.append([int(line[i]), int(line[i + 1])])
-                algorithm = line[-1]
-                item_dict[item_id] = ['polygon', p_list, algorithm, np.array(pen_color)]
-            elif line[0] == 'drawEllipse':
-                item_id = line[1]
-                x0 = int(line[2])
-                y0 = int(line[3])
-                x1 = int(line[4])
-                y1 = int(line[5])
-                item_dict[item_id] = ['ellipse', [[x0, y0], [x1, y1]], '', np.array(pen_color)]
-            elif line[0] == 'drawCurve':
-                item_id = line[1]
-                p_list = []
-                for i in range(2, len(line) - 1, 2):
-                    p_list.append([int(line[i]), int(line[i + 1])])
-                algorithm = line[-1]
-                item_dict[item_id] = ['curve', p_list, algorithm, np.array(pen_color)]
-            elif line[0] == 'translate':
-                item_id = line[1]
-                if item_dict.get(item_id) is not None:
-                    dx = int(line[2])
-                    dy = int(line[3])
-                    item_dict[item_id][1] = alg.translate(item_dict[item_id][1], dx, dy)
-            elif line[0] == 'rotate':
-                item_id = line[1]
-                if item_dict.get(item_id) is not None:
-                    x = int(line[2])
-                    y = int(line[3])
-                    r = int(line[4])
-                    item_dict[item_id][1] = alg.rotate(item_dict[item_id][1], x, y, r)
-            elif line[0] == 'scale':
-                item_id = line[1]
-                if item_dict.get(item_id) is not None:
-                    x = int(line[2])
-                    y = int(line[3])
-                    s = float(line[4])
-                    item_dict[item_id][1] = alg.scale(item_dict[item_id][1], x, y, s)
-            elif line[0] == 'clip':
-                item_id = line[1]
-                if item_dict.get(item_id) is not None:
-                    x0, y0 = [int(line[2]), int(line[3])]
-                    x1, y1 = [int(line[4]), int(line[5])]
-                    algorithm = line[6]
-                    item_dict[item_id][1] = alg.clip(item_dict[item_id][1], x0, y0, x1, y1, algorithm)
-
-            line = fp.readline()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_dir')
+    parser.add_argument('--jobs', type=int, default=1, help='并行合成saveCanvas的进程数')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='大于0时把每张画布按该边长分块，由--jobs个进程并行合成')
+    parser.add_argument('--cache-bytes', type=int, default=cg_cache.DEFAULT_BUDGET,
+                        help='栅格化结果缓存的内存预算（字节），为0时不缓存')
+    parser.add_argument('--snapshots', choices=['scene', 'tiles'], default='scene',
+                        help='--jobs模式下saveCanvas的快照方式：scene在子进程中完整合成，tiles只复制变化过的图块')
+    parser.add_argument('--profile', action='store_true', help='统计各阶段的耗时，以及各指令和各图元的耗时、像素数和分配的内存，并打印汇总表')
+    parser.add_argument('--profile-json', help='剖析结果的JSON输出路径，隐含--profile')
+    parser.add_argument('--profile-trace', help='Chrome trace输出路径，隐含--profile')
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    raster_cache.budget = args.cache_bytes
+
+    interpreter = Interpreter(args.output_dir, args.jobs, args.tile_size, args.snapshots)
+    commands = cmd.parse_file(args.input_file)
+    if not (args.profile or args.profile_json or args.profile_trace):
+        interpreter.run(commands)
+    else:
+        profiler = cg_profile.Profiler(trace=args.profile_trace is not None)
+        disable = enable_profiling(interpreter, profiler)
+        try:
+            interpreter.run(profiler.commands(commands))
+        finally:
+            disable()
+        profiler.summary()
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+        if args.profile_trace:
+            profiler.write_trace(args.profile_trace)
@@ -2,7 +2,13 @@
 # -*- coding:utf-8 -*-
 import math
 import sys
+from time import perf_counter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import cg_algorithms as alg
+import cg_cache
+import cg_spatial
+import cg_scene
 from typing import Optional
 from PyQt5.QtWidgets import (
     QApplication,
@@ -17,8 +23,88 @@ from PyQt5.QtWidgets import (
     QStyleOptionGraphicsItem,
     QInputDialog
 )
-from PyQt5.QtGui import QPainter, QMouseEvent, QColor
-from PyQt5.QtCore import QRectF
+from PyQt5 import sip
+from PyQt5.QtGui import QPainter, QMouseEvent, QColor, QImage, QPen, qAlpha
+from PyQt5.QtCore import QObject, QRectF, QPointF, Qt, QTimer, pyqtSignal
+
+
+# 点选图元时允许的误差（像素）
+PICK_TOLERANCE = 3
+# 在后台线程中栅格化的图元类型，其余类型直接在paint中栅格化
+BACKGROUND_ITEM_TYPES = ('curve',)
+
+# 编辑命令：edit_type为'translate'、'rotate'、'scale'或'clip'；
+# points依次为平移的起点和终点、旋转或缩放的中心、裁剪窗口的两个对角；param为旋转角度或缩放系数；algorithm为裁剪算法
+Edit = namedtuple('Edit', ['edit_type', 'points', 'param', 'algorithm'])
+
+
+def edit_points(item_type, p_list, edit):
+    """
+    :param item_type: (string) 图元类型
+    :param p_list: (list of list of int) 编辑前的图元参数
+    :param edit: (Edit) 编辑命令
+    :return: (list of list of int) 编辑后的图元参数，不修改p_list
+    """
+    if edit.edit_type == 'translate':
+        (x0, y0), (x1, y1) = edit.points
+        return alg.translate(p_list, x1 - x0, y1 - y0)
+    elif edit.edit_type == 'rotate':
+        x, y = edit.points[0]
+        return alg.rotate(p_list, x, y, edit.param)
+    elif edit.edit_type == 'scale':
+        x, y = edit.points[0]
+        return alg.scale(p_list, x, y, edit.param)
+    elif edit.edit_type == 'clip':
+        # 与cg_cli一致，只裁剪线段和多边形，裁剪窗口的两个对角可以按任意顺序给出
+        (x0, y0), (x1, y1) = edit.points
+        x_min, x_max = min(x0, x1), max(x0, x1)
+        y_min, y_max = min(y0, y1), max(y0, y1)
+        if item_type == 'line':
+            if not p_list:
+                return p_list
+            kept, rejected = alg.clip_lines([p_list], x_min, y_min, x_max, y_max, edit.algorithm)
+            return [] if rejected[0] else kept[0]
+        elif item_type == 'polygon':
+            return alg.clip_polygon(p_list, x_min, y_min, x_max, y_max)
+    return p_list
+
+
+class RasterWorker(QObject):
+    """
+    后台栅格化：在线程池中计算图元的区段，完成后经由信号回到UI线程交给图元。
+    栅格化是纯Python代码，多个线程并不能并行，只用一个线程：UI线程仍能按时处理事件，任务也按提交顺序完成
+    """
+    finished = pyqtSignal(object, object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # 任务可能在add_done_callback之前就已完成，这时信号从UI线程本身发出；
+        # 显式排队，保证deliver总在submit返回、调用者记下pending之后才执行
+        self.finished.connect(self.deliver, Qt.QueuedConnection)
+
+    def submit(self, item, raster_key, shift):
+        """
+        :param item: (MyItem) 图元
+        :param raster_key: (tuple) 图元的(规范化的缓存键, 颜色)
+        :param shift: (tuple of int: (dx, dy)) 从规范位置到实际位置的平移量
+        :return: (concurrent.futures.Future) 还没开始的任务可以cancel
+        """
+        future = self.executor.submit(cg_cache.render_spans, raster_key[0])
+
+        def done(f):
+            if not f.cancelled() and f.exception() is None:
+                self.finished.emit(item, (raster_key, shift), f.result())
+        future.add_done_callback(done)
+        return future
+
+    def deliver(self, item, job, spans):
+        # 任务完成前画布可能已经被重置，图元已被删除
+        if not sip.isdeleted(item):
+            item.raster_ready(job[0], job[1], spans)
+
+
+raster_worker = RasterWorker()
 
 
 class MyCanvas(QGraphicsView):
@@ -30,6 +116,8 @@ class MyCanvas(QGraphicsView):
         self.main_window = None
         self.list_widget = None
         self.item_dict = {}
+        self.model = cg_scene.Scene()   # 全部图元的类型、参数、算法和颜色，MyItem只保存显示相关的状态
+        self.spatial_index = cg_spatial.GridIndex()
         self.selected_id = ''
 
         self.status = ''
@@ -38,14 +126,28 @@ class MyCanvas(QGraphicsView):
         self.temp_id = ''
         self.temp_item = None
         self.color = [0, 0, 0]
+        self.edit_list = []         # 正在进行的编辑中鼠标给出的点，没有按下鼠标时为空
+        self.clip_rect = None       # 正在拖出的裁剪窗口，在前景中用虚线画出
+
+        # 鼠标移动事件的合并：每个显示帧最多按最新的光标位置更新一次图元
+        screen = QApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        self.frame_interval = 1 / (rate if rate > 0 else 60)
+        self.pending_move = None        # 还没处理的最新光标位置
+        self.last_move = 0.0            # 上一次处理移动的时刻
+        self.move_timer = QTimer(self)
+        self.move_timer.setSingleShot(True)
+        self.move_timer.timeout.connect(self.apply_move)
+        self.input_time = None          # 还没处理的移动事件中最早的一个到达的时刻
+        self.paint_input_time = None    # 已经处理、等待重绘的移动事件中最早的一个到达的时刻
+        self.max_latency = 0.0          # 本次拖动中输入到绘制的最大延迟
 
     def change_status(self, status):
         if self.temp_item is not None:
             if self.status == 'curve' or self.status == 'polygon':
-                self.item_dict[self.temp_id] = self.temp_item
+                self.register_item(self.temp_item)
                 self.list_widget.addItem(self.temp_id)
-            elif self.status == 'edit':
-                self.temp_item.edit_type = ''
+        self.edit_list = []
         self.status = status
 
     def start_draw_line(self, algorithm, item_id):
@@ -77,22 +179,56 @@ class MyCanvas(QGraphicsView):
             self.item_dict[self.selected_id].selected = False
             self.selected_id = ''
 
-    def selection_changed(self, selected):
+    def register_item(self, item):
+        """绘制完成的图元加入item_dict和空间索引，之后它的包围盒变化时自动更新索引"""
+        self.item_dict[item.id] = item
+        item.spatial_index = self.spatial_index
+        item.geometry_changed()
+
+    def pick(self, x, y):
+        """:return: (string) 点(x, y)附近最上层图元的ID，没有时为''"""
+        t = PICK_TOLERANCE
+        for item_id in self.spatial_index.query(x - t, y - t, x + t, y + t):
+            if self.item_dict[item_id].hit(x, y, t):
+                return item_id
+        return ''
+
+    def update_region(self, *rects):
+        """只重绘给定的区域（场景坐标），外扩1像素以包含选中框的右边和下边"""
+        dirty = QRectF()
+        for rect in rects:
+            dirty = dirty.united(rect)
+        self.updateScene([dirty.adjusted(-1, -1, 1, 1)])
 
+    def selection_changed(self, selected):
+        dirty = []
         if self.selected_id != '':
             self.item_dict[self.selected_id].selected = False
-            self.item_dict[self.selected_id].edit_type = ''
+            dirty.append(self.item_dict[self.selected_id].boundingRect())
         self.selected_id = selected
         self.status = ''
         if selected != '':
             self.item_dict[selected].selected = True
-            self.item_dict[selected].update()
-            self.updateScene([self.sceneRect()])
+            dirty.append(self.item_dict[selected].boundingRect())
+        if dirty:
+            self.update_region(*dirty)
 
     def mousePressEvent(self, event: QMouseEvent) -> None:
+        self.apply_move()
+        self.max_latency = 0.0
         pos = self.mapToScene(event.localPos().toPoint())
         x = int(pos.x())
         y = int(pos.y())
+        dirty = None
+        if self.status == '':
+            # 空闲时点击画布选择图元，经由list_widget的信号调用selection_changed
+            picked = self.pick(x, y)
+            if picked == '':
+                self.list_widget.setCurrentRow(-1)
+            else:
+                self.list_widget.setCurrentItem(self.list_widget.findItems(picked, Qt.MatchExactly)[0])
+            super().mousePressEvent(event)
+            return
         if self.status == 'edit':
             if self.selected_id == '':
                 self.status = ''
@@ -101,72 +237,140 @@ class MyCanvas(QGraphicsView):
             else:
                 self.temp_item = self.item_dict[self.selected_id]
                 if self.edit_status == 'translate' or self.edit_status == 'clip':
-                    self.temp_item.edit_list = [[x, y], [x, y]]
-                    self.temp_item.edit_type = self.edit_status
+                    self.edit_list = [[x, y], [x, y]]
                 else:
-                    self.temp_item.edit_type = ''
-                    self.temp_item.edit_list = [[x, y]]
+                    self.edit_list = [[x, y]]
+                if self.edit_status == 'clip':
+                    self.clip_rect = QRectF(x, y, 0, 0)
+                    dirty = self.clip_rect
         else:
             if self.status == 'line' or self.status == 'ellipse':
-                self.temp_item = MyItem(self.temp_id, self.status, [[x, y], [x, y]], self.temp_algorithm, self.color)
+                self.temp_item = MyItem(self.temp_id, self.status, [[x, y], [x, y]], self.temp_algorithm, self.color,
+                                        self.model)
                 self.scene().addItem(self.temp_item)
+                dirty = self.temp_item.boundingRect()
             else:
                 if self.temp_item is None:
-                    self.temp_item = MyItem(self.temp_id, self.status, [[x, y]], self.temp_algorithm, self.color)
+                    self.temp_item = MyItem(self.temp_id, self.status, [[x, y]], self.temp_algorithm, self.color,
+                                            self.model)
                     self.scene().addItem(self.temp_item)
+                    dirty = self.temp_item.boundingRect()
                 else:
-                    self.temp_item.p_list.append([x, y])
+                    old = self.temp_item.boundingRect()
+                    self.temp_item.p_list = self.temp_item.p_list + [[x, y]]
+                    dirty = old.united(self.temp_item.boundingRect())
 
-        if self.status != 'edit' or self.edit_status == 'translate':
-            self.updateScene([self.sceneRect()])
+        if dirty is not None:
+            self.update_region(dirty)
         super().mousePressEvent(event)
 
     def mouseMoveEvent(self, event: QMouseEvent) -> None:
         pos = self.mapToScene(event.localPos().toPoint())
-        x = int(pos.x())
-        y = int(pos.y())
+        if self.temp_item is None:
+            super().mouseMoveEvent(event)
+            return
+        # 只记下最新的位置，距上一次处理不足一帧时等到下一帧再处理
+        self.pending_move = (int(pos.x()), int(pos.y()))
+        if self.input_time is None:
+            self.input_time = perf_counter()
+        wait = self.last_move + self.frame_interval - perf_counter()
+        if wait <= 0:
+            self.apply_move()
+        elif not self.move_timer.isActive():
+            self.move_timer.start(math.ceil(wait * 1000))
+        super().mouseMoveEvent(event)
+
+    def apply_move(self):
+        """按最新的光标位置更新正在绘制或编辑的图元，并请求重绘受影响的区域"""
+        self.move_timer.stop()
+        if self.pending_move is None or self.temp_item is None:
+            return
+        x, y = self.pending_move
+        self.pending_move = None
+        self.last_move = perf_counter()
+        input_time = self.input_time
+        self.input_time = None
+        old = self.temp_item.boundingRect()
+        dirty = None
         if self.status == 'line' or self.status == 'ellipse':
-            self.temp_item.p_list[1] = [x, y]
+            self.temp_item.move_point(1, [x, y])
+            dirty = self.temp_item.boundingRect()
         elif self.status == 'polygon' or self.status == 'curve':
-            self.temp_item.p_list[-1] = [x, y]
-        elif self.status == 'edit':
-            if self.edit_status == 'translate' or self.edit_status == 'clip':
-                self.temp_item.edit_list[1] = [x, y]
+            self.temp_item.move_point(-1, [x, y])
+            dirty = self.temp_item.boundingRect()
+        elif self.status == 'edit' and self.edit_list:
+            if self.edit_status == 'translate':
+                # 每次移动都是一条从上一个位置到当前位置的平移命令
+                self.temp_item.apply_edit(Edit('translate', [self.edit_list[1], [x, y]], 0, ''))
+                self.edit_list[1] = [x, y]
+                dirty = self.temp_item.boundingRect()
+            elif self.edit_status == 'clip':
+                self.edit_list[1] = [x, y]
+                old = self.clip_rect
+                self.clip_rect = self.edit_rect()
+                dirty = self.clip_rect
             else:
-                self.temp_item.edit_list[0] = [x, y]
-        if self.status != 'edit' or self.edit_status == 'translate':
-            self.updateScene([self.sceneRect()])
-        super().mouseMoveEvent(event)
+                # 旋转和缩放的中心跟随鼠标，松开后才应用
+                self.edit_list[0] = [x, y]
+        if dirty is not None:
+            # 只有请求了重绘的移动才统计延迟
+            if self.paint_input_time is None:
+                self.paint_input_time = input_time
+            self.update_region(old, dirty)
+
+    def edit_rect(self):
+        """:return: (QRectF) edit_list中两个点围成的矩形"""
+        (x0, y0), (x1, y1) = self.edit_list
+        return QRectF(QPointF(min(x0, x1), min(y0, y1)), QPointF(max(x0, x1), max(y0, y1)))
+
+    def drawForeground(self, painter: QPainter, rect: QRectF) -> None:
+        if self.clip_rect is not None:
+            painter.setPen(QPen(QColor(0, 0, 255), 0, Qt.DashLine))
+            painter.drawRect(self.clip_rect)
+
+    def paintEvent(self, event) -> None:
+        super().paintEvent(event)
+        if self.paint_input_time is not None:
+            latency = perf_counter() - self.paint_input_time
+            self.paint_input_time = None
+            self.max_latency = max(self.max_latency, latency)
+            if self.main_window is not None:
+                self.main_window.statusBar().showMessage('输入到绘制的延迟：%.1fms（本次拖动最大%.1fms，一帧%.1fms）' % (
+                    latency * 1000, self.max_latency * 1000, self.frame_interval * 1000))
 
     def mouseReleaseEvent(self, event: QMouseEvent) -> None:
+        # 先处理合并后还没处理的移动，松开时的图元与最后的光标位置一致
+        self.apply_move()
         pos = self.mapToScene(event.localPos().toPoint())
         if self.status == 'line' or self.status == 'ellipse':
-            self.item_dict[self.temp_id] = self.temp_item
+            self.register_item(self.temp_item)
             self.list_widget.addItem(self.temp_id)
             self.finish_draw()
         elif self.status == 'polygon' or self.status == 'curve':
             x = int(pos.x())
             y = int(pos.y())
-            self.temp_item.p_list[-1] = [x, y]
-            self.updateScene([self.sceneRect()])
-        else:
+            old = self.temp_item.boundingRect()
+            self.temp_item.move_point(-1, [x, y])
+            self.update_region(old, self.temp_item.boundingRect())
+        elif self.status == 'edit' and self.edit_list:
+            # 旋转、缩放和裁剪在松开鼠标时作为一条命令应用一次
+            old = self.temp_item.boundingRect()
             if self.edit_status == 'rotate':
                 ok = 0
                 while not ok:
                     text, ok = QInputDialog.getDouble(self, 'Double Input Dialog', '请输入旋转度数')
-                self.temp_item.edit_type = self.edit_status
-                self.temp_item.edit_param = text
-                self.updateScene([self.sceneRect()])
+                self.temp_item.apply_edit(Edit('rotate', self.edit_list, text, ''))
             elif self.edit_status == 'scale':
                 ok = 0
                 while not ok:
                     text, ok = QInputDialog.getDouble(self, 'Double Input Dialog', '请输入缩放系数')
-                self.temp_item.edit_param = text
-                self.temp_item.edit_type = self.edit_status
-                self.updateScene([self.sceneRect()])
+                self.temp_item.apply_edit(Edit('scale', self.edit_list, text, ''))
             elif self.edit_status == 'clip':
-                self.temp_item.edit_algorithm = self.temp_algorithm
-                self.updateScene([self.sceneRect()])
+                self.temp_item.apply_edit(Edit('clip', self.edit_list, 0, self.temp_algorithm))
+                self.update_region(self.clip_rect)
+                self.clip_rect = None
+            self.edit_list = []
+            self.update_region(old, self.temp_item.boundingRect())
 
         super().mouseReleaseEvent(event)
 
@@ -175,71 +379,178 @@ class MyItem(QGraphicsItem):
     """
     自定义图元类，继承自QGraphicsItem
     """
-    def __init__(self, item_id: str, item_type: str, p_list: list, algorithm: str = '', color=None, parent: QGraphicsItem = None):
+    def __init__(self, item_id: str, item_type: str, p_list: list, algorithm: str = '', color=None,
+                 model: cg_scene.Scene = None, parent: QGraphicsItem = None):
         """
 
         :param item_id: 图元ID
         :param item_type: 图元类型，'line'、'polygon'、'ellipse'、'curve'等
         :param p_list: 图元参数
         :param algorithm: 绘制算法，'DDA'、'Bresenham'、'Bezier'、'B-spline'等
+        :param model: 保存图元数据的场景，为None时使用单独的场景
         :param parent:
         """
         super().__init__(parent)
         if color is None:
             color = [0, 0, 0]
+        if model is None:
+            model = cg_scene.Scene()
         self.id = item_id           # 图元ID
-        self.item_type = item_type  # 图元类型，'line'、'polygon'、'ellipse'、'curve'等
-        self.p_list = p_list        # 图元参数
-        self.algorithm = algorithm  # 绘制算法，'DDA'、'Bresenham'、'Bezier'、'B-spline'等
+        # 图元类型、参数、算法和颜色保存在model的第row行
+        self.model = model
+        self.row = model.add(item_id, item_type, p_list, algorithm, color)
         self.selected = False
-        self.edit_type = ''
-        self.edit_list = []
-        self.edit_param = 0
-        self.edit_algorithm = ''
-        self.color = color
-
-    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: Optional[QWidget] = ...) -> None:
-        if self.edit_type == 'translate':
-            x0, y0 = self.edit_list[0]
-            x1, y1 = self.edit_list[1]
-            self.p_list = alg.translate(self.p_list, x1 - x0, y1 - y0)
-        elif self.edit_type == 'rotate':
-            x0, y0 = self.edit_list[0]
-            self.p_list = alg.rotate(self.p_list, x0, y0, self.edit_param)
-        elif self.edit_type == 'scale':
-            x0, y0 = self.edit_list[0]
-            self.p_list = alg.scale(self.p_list, x0, y0, self.edit_param)
-        elif self.edit_type == 'clip':
-            x0, y0 = self.edit_list[0]
-            x1, y1 = self.edit_list[1]
-            self.p_list = alg.clip(self.p_list, x0, y0, x1, y1, self.edit_algorithm)
-
-        if self.item_type == 'line':
-            item_pixels = alg.draw_line(self.p_list, self.algorithm)
-        elif self.item_type == 'polygon':
-            item_pixels = alg.draw_polygon(self.p_list, self.algorithm)
-        elif self.item_type == 'ellipse':
-            item_pixels = alg.draw_ellipse(self.p_list)
-        elif self.item_type == 'curve':
-            if len(self.p_list) >= 2:
-                item_pixels = alg.draw_curve(self.p_list, self.algorithm)
+        self.raster_key = None      # 生成raster时的(规范化的缓存键, 颜色)
+        self.raster = QImage()      # 规范位置上的栅格化结果，透明背景的QImage
+        self.raster_origin = (0, 0)  # raster左上角在规范位置上的坐标
+        self.raster_shift = (0, 0)  # 从规范位置到实际位置的平移量
+        self.pending = None         # 后台栅格化中的(raster_key, Future)
+        self.bounding_rect = None   # 缓存的boundingRect，p_list变化后置为None
+        self.spatial_index = None   # 绘制完成后登记到的cg_spatial.GridIndex
+
+    @property
+    def item_type(self):
+        """图元类型，'line'、'polygon'、'ellipse'、'curve'等"""
+        return self.model.item_type(self.row)
+
+    @property
+    def algorithm(self):
+        """绘制算法，'DDA'、'Bresenham'、'Bezier'、'B-spline'等"""
+        return self.model.algorithm(self.row)
+
+    @property
+    def color(self):
+        return self.model.colors[self.row].tolist()
+
+    @property
+    def p_list(self):
+        """图元参数；返回的是副本，修改后须重新赋值"""
+        return self.model.points(self.row)
+
+    @p_list.setter
+    def p_list(self, p_list):
+        self.model.set_points(self.row, p_list)
+        self.geometry_changed()
+
+    def move_point(self, index, point):
+        """修改第index个控制点，绘制过程中控制点跟随鼠标"""
+        p_list = self.p_list
+        p_list[index] = point
+        self.p_list = p_list
+
+    def apply_edit(self, edit):
+        """把编辑命令应用到p_list上，每条命令只应用一次
+
+        :param edit: (Edit) 编辑命令
+        """
+        self.p_list = edit_points(self.item_type, self.p_list, edit)
+
+    def geometry_changed(self):
+        """p_list被修改后调用，通知场景并重新计算boundingRect；raster在缓存键变化时由update_raster重新生成"""
+        self.prepareGeometryChange()
+        self.bounding_rect = None
+        self.boundingRect()
+
+    def hit(self, x, y, tolerance=0):
+        """:return: (bool) 点(x, y)周围tolerance像素内是否有图元的像素"""
+        ox, oy = self.update_raster()
+        image = self.raster
+        for py in range(y - oy - tolerance, y - oy + tolerance + 1):
+            for px in range(x - ox - tolerance, x - ox + tolerance + 1):
+                if image.valid(px, py) and qAlpha(image.pixel(px, py)) > 0:
+                    return True
+        return False
+
+    def update_raster(self):
+        """图元形状、算法或颜色变化时重新生成raster；只是平移时规范化的缓存键不变，直接复用。
+        BACKGROUND_ITEM_TYPES中没有缓存的图元提交到后台栅格化，在结果到达之前raster仍是上一次完成的结果
+
+        :return: (tuple of int: (x, y)) raster左上角在画布上的坐标
+        """
+        key, dx, dy = cg_cache.canonical(self.item_type, self.p_list, self.algorithm)
+        raster_key = (key, tuple(self.color))
+        if self.pending is not None and self.pending[0] != raster_key:
+            # p_list又变了，还没开始的旧任务不必再做，已经开始的任务完成后作为中间结果显示
+            self.pending[1].cancel()
+            self.pending = None
+        if raster_key == self.raster_key:
+            self.raster_shift = (dx, dy)
+        elif self.pending is None:
+            if self.item_type in BACKGROUND_ITEM_TYPES and key not in cg_cache.span_cache:
+                self.pending = (raster_key, raster_worker.submit(self, raster_key, (dx, dy)))
             else:
-                item_pixels = []
+                spans = cg_cache.draw_spans(self.item_type, [list(p) for p in key[2]], self.algorithm)
+                self.set_raster(raster_key, (dx, dy), spans)
+        return self.raster_origin[0] + self.raster_shift[0], self.raster_origin[1] + self.raster_shift[1]
+
+    def set_raster(self, raster_key, shift, spans):
+        """把规范位置上的区段画到新的raster中"""
+        if spans:
+            x_min = min(span[1] for span in spans)
+            y_min = min(span[0] for span in spans)
+            width = max(span[2] for span in spans) - x_min + 1
+            height = max(span[0] for span in spans) - y_min + 1
+            image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            image_painter = QPainter(image)
+            # 同一行上连续的像素用一次drawLine画出
+            image_painter.setPen(QColor(self.color[0], self.color[1], self.color[2]))
+            for y, x_start, x_end in spans:
+                image_painter.drawLine(x_start - x_min, y - y_min, x_end - x_min, y - y_min)
+            image_painter.end()
         else:
-            item_pixels = []
+            # 没有像素时用空的QImage，drawImage不绘制任何内容，包围盒也不受影响
+            x_min = y_min = 0
+            image = QImage()
+        self.raster_key = raster_key
+        self.raster = image
+        self.raster_origin = (x_min, y_min)
+        self.raster_shift = shift
+
+    def raster_ready(self, raster_key, shift, spans):
+        """后台栅格化完成，在UI线程中调用"""
+        cg_cache.span_cache.put(raster_key[0], spans, cg_cache.SPAN_BYTES * len(spans))
+        if self.pending is None and raster_key != self.raster_key:
+            # 结果过时，而当前的raster已经与p_list一致
+            return
+        if self.pending is not None and self.pending[0] == raster_key:
+            self.pending = None
+        self.set_raster(raster_key, shift, spans)
+        self.geometry_changed()
+        self.update()
 
-        for p in item_pixels:
-            painter.setPen(QColor(self.color[0], self.color[1], self.color[2]))
-            painter.drawPoint(*p)
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: Optional[QWidget] = ...) -> None:
+        # paint不修改p_list，编辑由apply_edit完成
+        # 整个图元用一次drawImage画出，平移中的图元每次重绘都复用同一张raster
+        x, y = self.update_raster()
+        painter.drawImage(QPointF(x, y), self.raster)
+        if self.pending is not None:
+            # 新的结果还没算完，用虚线画出控制多边形作为预览
+            painter.setPen(QPen(QColor(self.color[0], self.color[1], self.color[2]), 0, Qt.DashLine))
+            for (x0, y0), (x1, y1) in zip(self.p_list, self.p_list[1:]):
+                painter.drawLine(QPointF(x0, y0), QPointF(x1, y1))
         if self.selected:
             painter.setPen(QColor(255, 0, 0))
             painter.drawRect(self.boundingRect())
 
-        if self.edit_type == 'translate':
-            self.edit_list = [[x1, y1], [x1, y1]]
-
     def boundingRect(self) -> QRectF:
-        if self.item_type == 'polygon' or self.item_type == 'curve':
+        if self.bounding_rect is None:
+            rect = self.bounding_rect = self.compute_bounding_rect()
+            if self.spatial_index is not None:
+                self.spatial_index.insert(self.id, (rect.left(), rect.top(), rect.right(), rect.bottom()))
+        return self.bounding_rect
+
+    def compute_bounding_rect(self) -> QRectF:
+        """控制点的包围盒外扩1像素，再并上raster覆盖的范围（椭圆和曲线的像素可能超出控制点的包围盒）"""
+        x, y = self.update_raster()
+        raster_rect = QRectF(x, y, self.raster.width(), self.raster.height())
+        if not self.p_list:
+            # 被整体裁掉的图元
+            x = 1
+            y = 1
+            w = 0
+            h = 0
+        elif self.item_type == 'polygon' or self.item_type == 'curve':
             x_list = []
             y_list = []
             for i in self.p_list:
@@ -261,7 +572,7 @@ class MyItem(QGraphicsItem):
             y = 1
             w = 0
             h = 0
-        return QRectF(x - 1, y - 1, w + 2, h + 2)
+        return QRectF(x - 1, y - 1, w + 2, h + 2).united(raster_rect)
 
 
 class MainWindow(QMainWindow):
@@ -279,6 +590,8 @@ class MainWindow(QMainWindow):
         # 使用QGraphicsView作为画布
         self.scene = QGraphicsScene(self)
         self.scene.setSceneRect(0, 0, 600, 600)
+        # 图元在拖动中几何形状经常变化，不使用BSP索引，点选由cg_spatial负责
+        self.scene.setItemIndexMethod(QGraphicsScene.NoIndex)
         self.canvas_widget = MyCanvas(self.scene, self)
         self.canvas_widget.setFixedSize(602, 602)
         self.canvas_widget.main_window = self
@@ -349,15 +662,15 @@ class MainWindow(QMainWindow):
     def set_pen_action(self):
         ok = 0
         while not ok:
-            text, ok = QInputDialog.getInt(self, 'Double Input Int', '请输入R')
+            text, ok = QInputDialog.getInt(self, 'Double Input Int', '请输入R', 0, 0, 255)
         r = text
         ok = 0
         while not ok:
-            text, ok = QInputDialog.getInt(self, 'Double Input Int', '请输入G')
+            text, ok = QInputDialog.getInt(self, 'Double Input Int', '请输入G', 0, 0, 255)
         g = text
         ok = 0
         while not ok:
-            text, ok = QInputDialog.getInt(self, 'Double Input Int', '请输入B')
+            text, ok = QInputDialog.getInt(self, 'Double Input Int', '请输入B', 0, 0, 255)
         b = text
         self.canvas_widget.color = [r, g, b]
 
@@ -372,6 +685,8 @@ class MainWindow(QMainWindow):
         self.canvas_widget.temp_algorithm = ''
         self.canvas_widget.list_widget.clear()
         self.canvas_widget.item_dict.clear()
+        self.canvas_widget.model = cg_scene.Scene()
+        self.canvas_widget.spatial_index.clear()
 
 
     def line_naive_action(self):
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 指令文件解析：把文本指令编译为紧凑的Command记录，可一次编译、多次执行
+from array import array
+from collections import namedtuple
+
+# 操作码
+RESET_CANVAS = 0
+SAVE_CANVAS = 1
+SET_COLOR = 2
+DRAW_LINE = 3
+DRAW_POLYGON = 4
+DRAW_ELLIPSE = 5
+DRAW_CURVE = 6
+FILL_POLYGON = 7
+TRANSLATE = 8
+ROTATE = 9
+SCALE = 10
+CLIP = 11
+
+OPCODES = {
+    'resetCanvas': RESET_CANVAS,
+    'saveCanvas': SAVE_CANVAS,
+    'setColor': SET_COLOR,
+    'drawLine': DRAW_LINE,
+    'drawPolygon': DRAW_POLYGON,
+    'drawEllipse': DRAW_ELLIPSE,
+    'drawCurve': DRAW_CURVE,
+    'fillPolygon': FILL_POLYGON,
+    'translate': TRANSLATE,
+    'rotate': ROTATE,
+    'scale': SCALE,
+    'clip': CLIP,
+}
+
+# op: 操作码
+# item_id: 图元ID，没有时为''
+# text: 字符串参数（算法名或saveCanvas的文件名），没有时为''
+# ints: (array of int) 整数参数，坐标按x0, y0, x1, y1, ...展开
+# value: (float) scale的缩放倍数，其余指令为0.0
+Command = namedtuple('Command', ['op', 'item_id', 'text', 'ints', 'value'])
+
+# 读取指令文件时每次读入的字符数
+CHUNK_SIZE = 1 << 20
+
+
+def parse_line(line):
+    """把一行指令编译为Command，空行和无法识别的指令返回None"""
+    fields = line.split()
+    if not fields:
+        return None
+    op = OPCODES.get(fields[0])
+    if op is None:
+        return None
+    if op == RESET_CANVAS or op == SET_COLOR:
+        return Command(op, '', '', array('i', map(int, fields[1:])), 0.0)
+    if op == SAVE_CANVAS:
+        return Command(op, '', fields[1], array('i'), 0.0)
+    if op == DRAW_ELLIPSE:
+        return Command(op, fields[1], '', array('i', map(int, fields[2:6])), 0.0)
+    if op == FILL_POLYGON:
+        return Command(op, fields[1], 'Scanline', array('i', map(int, fields[2:])), 0.0)
+    if op == TRANSLATE or op == ROTATE:
+        return Command(op, fields[1], '', array('i', map(int, fields[2:])), 0.0)
+    if op == SCALE:
+        return Command(op, fields[1], '', array('i', map(int, fields[2:4])), float(fields[4]))
+    # drawLine、drawPolygon、drawCurve、clip：最后一个参数是算法名
+    return Command(op, fields[1], fields[-1], array('i', map(int, fields[2:-1])), 0.0)
+
+
+def iter_lines(fp, chunk_size=CHUNK_SIZE):
+    """按块读取文件并逐行产出，避免逐行调用readline"""
+    tail = ''
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def parse_file(input_file, chunk_size=CHUNK_SIZE):
+    """流式解析指令文件
+
+    :param input_file: (string) 指令文件路径
+    :param chunk_size: (int) 每次读入的字符数
+    :return: (generator of Command) 按文件顺序产出的指令
+    """
+    with open(input_file, 'r') as fp:
+        for line in iter_lines(fp, chunk_size):
+            command = parse_line(line)
+            if command is not None:
+                yield command
+
+
+def compile_file(input_file):
+    """一次性编译整个指令文件，结果可以反复交给cg_cli.Interpreter执行，也可以用pickle保存
+
+    :return: (list of Command) 全部指令
+    """
+    return list(parse_file(input_file))
+
+
+def points(ints):
+    """把展开的坐标还原为图元参数 [[x0, y0], [x1, y1], ...]"""
+    return [[x, y] for x, y in zip(ints[0::2], ints[1::2])]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 性能剖析：按指令、按图元ID和按阶段统计耗时、像素数和分配的内存，可以输出JSON或Chrome trace。
+# 所有计时都通过包装函数接入，不开启剖析时不产生任何开销；内存由tracemalloc统计，只在剖析期间开启
+import sys
+import json
+import tracemalloc
+from time import perf_counter
+import cg_parser as cmd
+
+# 操作码 -> 指令名
+OPCODE_NAMES = {op: name for name, op in cmd.OPCODES.items()}
+
+
+class Profiler:
+    """
+    剖析器：command包装指令，stage包装某个阶段的函数，commands包装指令流以统计解析耗时；
+    阶段可以嵌套，每个阶段只记独占时间（扣除其中嵌套的阶段）
+    """
+    def __init__(self, trace=False):
+        """
+        :param trace: (bool) 是否记录每一次计时事件，用于输出Chrome trace
+        """
+        self.opcodes = {}       # 指令名 -> [次数, 耗时, 像素数, 分配字节数]
+        self.items = {}         # 图元ID -> [次数, 耗时, 像素数, 分配字节数]
+        # 分配字节数是每次调用期间tracemalloc跟踪的内存峰值比调用开始时多出的部分，包括调用中已经释放的临时对象；
+        # 图元的统计包括以它为目标的指令，以及saveCanvas中栅格化它的调用
+        self.stages = {}        # 阶段名 -> [次数, 独占耗时]
+        self.events = [] if trace else None
+        self.children = []      # 正在计时的各层阶段中，已经结束的子阶段的总耗时
+        self.pixels = 0         # 已经栅格化的像素总数
+        self.peaks = []         # 正在统计内存的各层调用中，目前为止的内存峰值
+        self.origin = perf_counter()
+
+    def start(self):
+        """开始跟踪内存分配，剖析期间Python分配内存会变慢"""
+        tracemalloc.start()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def alloc_begin(self):
+        """:return: (int) 调用开始时跟踪的内存字节数，交给alloc_end"""
+        current, peak = tracemalloc.get_traced_memory()
+        # reset_peak会丢掉外层调用目前为止的峰值，先记下来
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        tracemalloc.reset_peak()
+        self.peaks.append(current)
+        return current
+
+    def alloc_end(self, base):
+        """:return: (int) 自alloc_begin以来内存峰值比开始时多出的字节数"""
+        peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        return peak - base
+
+    def add_stage(self, name, start, elapsed):
+        children = self.children.pop()
+        if self.children:
+            self.children[-1] += elapsed
+        entry = self.stages.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed - children
+        self.add_event(name, 'stage', start, elapsed)
+
+    def add_event(self, name, category, start, elapsed, args=None):
+        if self.events is not None:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': 0, 'tid': 0,
+                     'ts': (start - self.origin) * 1e6, 'dur': elapsed * 1e6}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    def stage(self, name, function):
+        """:return: (callable) 把每次调用计入阶段name的function"""
+        def timed(*args, **kwargs):
+            self.children.append(0.0)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_stage(name, start, perf_counter() - start)
+        return timed
+
+    def rasterize(self, function):
+        """
+        :param function: (callable: (item_id, scene) -> Pixels or Spans) 栅格化单个图元的函数
+        :return: (callable) 计入阶段'rasterize'，并把耗时和像素数记到图元ID上的function
+        """
+        staged = self.stage('rasterize', function)
+
+        def timed(item_id, scene):
+            base = self.alloc_begin()
+            start = perf_counter()
+            raster = staged(item_id, scene)
+            elapsed = perf_counter() - start
+            allocated = self.alloc_end(base)
+            pixels = len(raster)
+            self.pixels += pixels
+            entry = self.items.setdefault(item_id, [0, 0.0, 0, 0])
+            entry[1] += elapsed
+            entry[2] += pixels
+            entry[3] += allocated
+            return raster
+        return timed
+
+    def command(self, op, function):
+        """:return: (callable) 把每次执行计入操作码op和指令的图元ID的function"""
+        name = OPCODE_NAMES[op]
+
+        def timed(command):
+            base = self.alloc_begin()
+            pixels = self.pixels
+            start = perf_counter()
+            function(command)
+            elapsed = perf_counter() - start
+            pixels = self.pixels - pixels
+            allocated = self.alloc_end(base)
+            targets = [self.opcodes.setdefault(name, [0, 0.0, 0, 0])]
+            if command.item_id:
+                targets.append(self.items.setdefault(command.item_id, [0, 0.0, 0, 0]))
+            for entry in targets:
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] += pixels
+                entry[3] += allocated
+            self.add_event(name, 'command', start, elapsed, {'item_id': command.item_id, 'text': command.text})
+        return timed
+
+    def commands(self, commands):
+        """:return: (generator) 与commands相同的指令流，取下一条指令的耗时计入阶段'parse'"""
+        iterator = iter(commands)
+        while True:
+            self.children.append(0.0)
+            start = perf_counter()
+            try:
+                command = next(iterator)
+            except StopIteration:
+                self.children.pop()
+                return
+            self.add_stage('parse', start, perf_counter() - start)
+            yield command
+
+    def to_json(self):
+        """:return: (dict) 全部统计结果"""
+        def table(entries):
+            return {key: {'count': count, 'seconds': seconds, 'pixels': pixels, 'alloc_bytes': allocated}
+                    for key, (count, seconds, pixels, allocated) in entries.items()}
+        return {
+            'stages': {name: {'count': count, 'seconds': seconds} for name, (count, seconds) in self.stages.items()},
+            'opcodes': table(self.opcodes),
+            'items': table(self.items),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.to_json(), fp, indent=2)
+
+    def write_trace(self, path):
+        """输出可以在chrome://tracing或Perfetto中打开的trace文件"""
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': self.events or [], 'displayTimeUnit': 'ms'}, fp)
+
+    def summary(self, top=20, file=sys.stdout):
+        """打印各阶段、各指令和耗时最多的top个图元的统计表"""
+        print('%-12s %8s %12s' % ('stage', 'count', 'ms'), file=file)
+        for name, (count, seconds) in sorted(self.stages.items(), key=lambda e: -e[1][1]):
+            print('%-12s %8d %12.2f' % (name, count, seconds * 1000), file=file)
+        for title, entries in (('opcode', self.opcodes), ('item', self.items)):
+            print(file=file)
+            print('%-16s %8s %12s %12s %12s' % (title, 'count', 'ms', 'pixels', 'alloc_bytes'), file=file)
+            rows = sorted(entries.items(), key=lambda e: -e[1][1])
+            for key, (count, seconds, pixels, allocated) in rows[:top]:
+                print('%-16s %8d %12.2f %12d %12d' % (key, count, seconds * 1000, pixels, allocated), file=file)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 列式存储的场景：全部图元的控制点放在一块连续的坐标缓冲区中，类型、算法、颜色和变换矩阵各占一列，
+# 由cg_cli和cg_gui共用
+import numpy as np
+import cg_algorithms as alg
+
+# 图元类型及其编号
+ITEM_TYPE_NAMES = ('line', 'polygon', 'ellipse', 'curve')
+ITEM_TYPE_CODES = {name: code for code, name in enumerate(ITEM_TYPE_NAMES)}
+# 单位矩阵的前两行
+IDENTITY_ROWS = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+# 初始容量（图元数和控制点数）
+INITIAL_CAPACITY = 16
+
+
+def grow(array, size):
+    """:return: (numpy.ndarray) 第一维至少为size的数组，容量按两倍增长，原有内容保留"""
+    if len(array) >= size:
+        return array
+    capacity = max(size, 2 * len(array), INITIAL_CAPACITY)
+    result = np.zeros((capacity,) + array.shape[1:], array.dtype)
+    result[:len(array)] = array
+    return result
+
+
+def apply_matrices(coords, matrices):
+    """逐点应用仿射变换，运算顺序与alg.transform_points相同，结果按alg.to_int截断为整数
+
+    :param coords: (numpy.ndarray of int64: [[x, y], ...]) 控制点
+    :param matrices: (numpy.ndarray of float64: [[a, b, c, d, e, f], ...]) 每个控制点的变换矩阵的前两行
+    :return: (numpy.ndarray of int64: [[x, y], ...]) 变换后的控制点
+    """
+    xs = coords[:, 0].astype(np.float64)
+    ys = coords[:, 1].astype(np.float64)
+    points = np.empty((len(coords), 2), np.float64)
+    points[:, 0] = matrices[:, 0] * xs + matrices[:, 1] * ys + matrices[:, 2]
+    points[:, 1] = matrices[:, 3] * xs + matrices[:, 4] * ys + matrices[:, 5]
+    rounded = np.round(points)
+    points = np.where(np.abs(points - rounded) < 1e-9, rounded, points)
+    return points.astype(np.int64)
+
+
+class Scene:
+    """
+    列式场景：第row个图元的控制点是coords[offsets[row]:offsets[row] + counts[row]]，row即图元的绘制顺序；
+    控制点数目变化时新的控制点追加到缓冲区末尾，废弃的控制点超过一半时整理缓冲区
+    """
+    def __init__(self):
+        self.ids = []                                   # row -> 图元ID
+        self.index = {}                                 # 图元ID -> row
+        self.types = np.zeros(0, np.uint8)              # row -> ITEM_TYPE_NAMES中的编号
+        self.algorithms = np.zeros(0, np.uint8)         # row -> algorithm_names中的编号
+        self.colors = np.zeros((0, 3), np.uint8)        # row -> [R, G, B]
+        self.matrices = np.zeros((0, 6), np.float64)    # row -> 累积的仿射变换矩阵的前两行
+        self.transformed = np.zeros(0, bool)            # row -> 变换矩阵是否不是单位矩阵
+        self.offsets = np.zeros(0, np.int64)            # row -> 控制点在coords中的起始位置
+        self.counts = np.zeros(0, np.int32)             # row -> 控制点数
+        self.coords = np.zeros((0, 2), np.int64)        # 全部控制点
+        self.used = 0                                   # coords中已经使用的长度，含废弃的控制点
+        self.live = 0                                   # 未废弃的控制点数
+        self.algorithm_names = []
+        self.algorithm_codes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item_id):
+        return item_id in self.index
+
+    def __getstate__(self):
+        # 序列化时只保留用到的部分，得到紧凑的快照
+        self.compact()
+        state = dict(self.__dict__)
+        n = len(self.ids)
+        for name in ('types', 'algorithms', 'colors', 'matrices', 'transformed', 'offsets', 'counts'):
+            state[name] = state[name][:n]
+        state['coords'] = self.coords[:self.used]
+        return state
+
+    def row(self, item_id):
+        """:return: (int) 图元的序号，不存在时为None"""
+        return self.index.get(item_id)
+
+    def add(self, item_id, item_type, p_list, algorithm, color):
+        """添加图元；ID已存在时在原来的位置替换该图元，变换矩阵重置为单位矩阵
+
+        :param item_type: (string) ITEM_TYPE_NAMES中的图元类型
+        :param p_list: (list of list of int) 图元参数
+        :param algorithm: (string) 绘制算法
+        :param color: (list of int: [R, G, B]) 颜色
+        :return: (int) 图元的序号
+        """
+        row = self.index.get(item_id)
+        if row is None:
+            row = len(self.ids)
+            self.ids.append(item_id)
+            self.index[item_id] = row
+            if row == len(self.types):
+                for name in ('types', 'algorithms', 'colors', 'matrices', 'transformed', 'offsets', 'counts'):
+                    setattr(self, name, grow(getattr(self, name), row + 1))
+            self.counts[row] = 0
+        self.types[row] = ITEM_TYPE_CODES[item_type]
+        code = self.algorithm_codes.get(algorithm)
+        if code is None:
+            code = self.algorithm_codes[algorithm] = len(self.algorithm_names)
+            self.algorithm_names.append(algorithm)
+        self.algorithms[row] = code
+        self.colors[row] = color
+        self.set_points(row, p_list)
+        return row
+
+    def item_type(self, row):
+        return ITEM_TYPE_NAMES[self.types[row]]
+
+    def algorithm(self, row):
+        return self.algorithm_names[self.algorithms[row]]
+
+    def base_points(self, row):
+        """:return: (numpy.ndarray of int64) 变换前的控制点，是coords的视图"""
+        start = self.offsets[row]
+        return self.coords[start:start + self.counts[row]]
+
+    def set_points(self, row, p_list):
+        """替换图元的控制点，变换矩阵重置为单位矩阵"""
+        count = len(p_list)
+        self.live += count - int(self.counts[row])
+        if count > self.counts[row]:
+            start = self.used
+            self.coords = grow(self.coords, start + count)
+            self.used += count
+            self.offsets[row] = start
+        start = self.offsets[row]
+        if count:
+            self.coords[start:start + count] = p_list
+        self.counts[row] = count
+        self.matrices[row] = IDENTITY_ROWS
+        self.transformed[row] = False
+        if self.used > 2 * self.live + INITIAL_CAPACITY:
+            self.compact()
+
+    def matrix(self, row):
+        """:return: (tuple of tuple of float) 图元上累积的3x3仿射变换矩阵"""
+        a, b, c, d, e, f = self.matrices[row].tolist()
+        return (a, b, c), (d, e, f), (0, 0, 1)
+
+    def set_matrix(self, row, matrix):
+        (a, b, c), (d, e, f), _ = matrix
+        self.matrices[row] = (a, b, c, d, e, f)
+        self.transformed[row] = matrix != alg.IDENTITY_MATRIX
+
+    def points(self, row):
+        """:return: (list of list of int: [[x_0, y_0], [x_1, y_1], ...]) 应用变换矩阵后的图元参数"""
+        coords = self.base_points(row)
+        if not self.transformed[row]:
+            return coords.tolist()
+        return apply_matrices(coords, np.broadcast_to(self.matrices[row], (len(coords), 6))).tolist()
+
+    def all_points(self):
+        """对全部图元一次性应用各自的变换矩阵
+
+        :return: (tuple: (points, starts)) 按图元顺序排列的变换后的控制点，第row个图元是points[starts[row]:starts[row + 1]]
+        """
+        n = len(self.ids)
+        counts = self.counts[:n].astype(np.int64)
+        starts = np.zeros(n + 1, np.int64)
+        np.cumsum(counts, out=starts[1:])
+        # 每个控制点在coords中的位置
+        positions = np.arange(starts[-1]) + np.repeat(self.offsets[:n] - starts[:-1], counts)
+        coords = self.coords[positions]
+        transformed = np.repeat(self.transformed[:n], counts)
+        if transformed.any():
+            matrices = np.repeat(self.matrices[:n], counts, axis=0)[transformed]
+            coords[transformed] = apply_matrices(coords[transformed], matrices)
+        return coords, starts
+
+    def compact(self):
+        """按图元顺序重新排列控制点，去掉废弃的部分"""
+        n = len(self.ids)
+        counts = self.counts[:n].astype(np.int64)
+        starts = np.zeros(n + 1, np.int64)
+        np.cumsum(counts, out=starts[1:])
+        if starts[-1] == self.used:
+            return
+        positions = np.arange(starts[-1]) + np.repeat(self.offsets[:n] - starts[:-1], counts)
+        self.coords = self.coords[positions]
+        self.offsets[:n] = starts[:-1]
+        self.used = int(starts[-1])
+
+    def nbytes(self):
+        """:return: (int) 各列数组占用的字节数，不含图元ID"""
+        return sum(getattr(self, name).nbytes for name in (
+            'types', 'algorithms', 'colors', 'matrices', 'transformed', 'offsets', 'counts', 'coords'))
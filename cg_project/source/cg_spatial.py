@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# 图元包围盒的均匀网格索引，用于在画布上点选图元
+import math
+
+# 网格单元的边长
+GRID_CELL = 64
+
+
+class GridIndex:
+    """
+    均匀网格：每个图元登记在与其包围盒相交的所有单元中；包围盒变化时只改动新旧单元的差集。
+    每个图元还记录一个插入序号，序号越大越靠上层
+    """
+    def __init__(self, cell_size=GRID_CELL):
+        self.cell_size = cell_size
+        self.cells = {}     # (col, row) -> 图元ID集合
+        self.rects = {}     # 图元ID -> (x_min, y_min, x_max, y_max)
+        self.order = {}     # 图元ID -> 插入序号
+        self.counter = 0
+
+    def cell_keys(self, rect):
+        x_min, y_min, x_max, y_max = rect
+        size = self.cell_size
+        return {(col, row)
+                for col in range(math.floor(x_min / size), math.floor(x_max / size) + 1)
+                for row in range(math.floor(y_min / size), math.floor(y_max / size) + 1)}
+
+    def insert(self, item_id, rect):
+        """登记图元；已登记的图元只更新包围盒，保持原来的层次
+
+        :param rect: (tuple of float: (x_min, y_min, x_max, y_max)) 包围盒
+        """
+        if item_id in self.rects:
+            self.update(item_id, rect)
+            return
+        self.rects[item_id] = rect
+        self.order[item_id] = self.counter
+        self.counter += 1
+        for key in self.cell_keys(rect):
+            self.cells.setdefault(key, set()).add(item_id)
+
+    def update(self, item_id, rect):
+        old = self.rects.get(item_id)
+        if old is None or old == rect:
+            return
+        self.rects[item_id] = rect
+        old_keys = self.cell_keys(old)
+        new_keys = self.cell_keys(rect)
+        for key in old_keys - new_keys:
+            cell = self.cells[key]
+            cell.discard(item_id)
+            if not cell:
+                del self.cells[key]
+        for key in new_keys - old_keys:
+            self.cells.setdefault(key, set()).add(item_id)
+
+    def remove(self, item_id):
+        rect = self.rects.pop(item_id, None)
+        if rect is None:
+            return
+        del self.order[item_id]
+        for key in self.cell_keys(rect):
+            cell = self.cells[key]
+            cell.discard(item_id)
+            if not cell:
+                del self.cells[key]
+
+    def clear(self):
+        self.cells.clear()
+        self.rects.clear()
+        self.order.clear()
+
+    def query(self, x_min, y_min, x_max, y_max):
+        """
+        :return: (list of string) 包围盒与给定矩形相交的图元ID，最上层的在前
+        """
+        found = set()
+        for key in self.cell_keys((x_min, y_min, x_max, y_max)):
+            found |= self.cells.get(key, set())
+        result = []
+        for item_id in found:
+            x0, y0, x1, y1 = self.rects[item_id]
+            if x0 <= x_max and x_min <= x1 and y0 <= y_max and y_min <= y1:
+                result.append(item_id)
+        result.sort(key=self.order.get, reverse=True)
+        return result